@@ -6,7 +6,7 @@ from os import path, makedirs, walk, remove
 from threading import Event, Timer
 from zipfile import ZipFile, ZIP_DEFLATED
 
-from .logger import log
+from .logger import log, ERROR, WARNING
 
 
 class BackupManager:
@@ -19,7 +19,7 @@ class BackupManager:
         self.backup_dir = backup_dir
         self.backup_dest = backup_destination
         if interval_in_hours < 1:
-            log("Backup interval cannot be under 1 hour! It is set to 1.")
+            log("Backup interval cannot be under 1 hour! It is set to 1.", level=WARNING)
             interval_in_hours = 1
         self.interval_in_hours = interval_in_hours
         self.copies = copies
@@ -66,7 +66,7 @@ class BackupManager:
                 remove(oldest_file)
                 log(f"Removed old backup: '{oldest_file}'")
             except Exception as e:
-                log(f"Failed to remove '{oldest_file}': {e}")
+                log(f"Failed to remove '{oldest_file}': {e}", level=ERROR)
 
     def _schedule_backup(self):
         self.executor.submit(self.backup)
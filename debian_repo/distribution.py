@@ -1,23 +1,34 @@
+import fcntl
+import time
+from contextlib import contextmanager
 from datetime import datetime, timezone
-from os import path, makedirs
-from typing import List
+from os import path, makedirs, remove, replace, link, scandir, stat, walk
+from shutil import rmtree
+from typing import List, Tuple
 from threading import Lock
 from concurrent.futures import ThreadPoolExecutor
 
 from .helpers import generate_packages_file, generate_packages_gz_file, generate_inrelease_file, \
-    generate_release_gpg_file
-from .logger import log
+    generate_release_gpg_file, get_deb_source_name, get_pool_shard, append_packages_file, remove_packages_entries
+from .logger import log, ERROR, WARNING
 from .ops import do_hash
 
 
+PACKAGE_SUFFIXES = (".deb", ".udeb")
+ARCH_ALL = "all"
+# How long --migrate-pool keeps the flat copies after publishing the sharded indexes, so clients that fetched the
+# previous indexes can still download from the old paths.
+MIGRATION_GRACE_PERIOD_IN_SEC = 600
+
+
 class Distribution:
     def __init__(self, name: str, dist_dir: str, architectures: List[str], components: List[str], keyring_dir: str,
                  debian_dir: str,
-                 description: str):
+                 description: str, on_publish=None, sharded_pool=False):
         self.name = name
         self.dist_dir = dist_dir
         self.pool_dir = path.join(dist_dir, 'pool')
-        self.archs = architectures
+        self.archs = [arch for arch in architectures if arch != ARCH_ALL]
         self.components = components
         self.keyring_dir = keyring_dir
         self.debian_dir = debian_dir
@@ -26,6 +37,18 @@ class Distribution:
         self.update_mutex = Lock()
         self.update_wait_mutex = Lock()
         self.queued_update_requests = 0
+        self.on_publish = on_publish
+        self.sharded_pool = sharded_pool
+        # Serializes updates with other processes working on the same repository, e.g. --migrate-pool.
+        self.lock_path = path.join(debian_dir, f".{name}.lock")
+
+    @contextmanager
+    def __update_lock__(self):
+        with self.update_mutex:
+            makedirs(self.debian_dir, exist_ok=True)
+            with open(self.lock_path, "a") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                yield
 
     def create_pool_directory(self):
         makedirs(self.pool_dir, exist_ok=True)
@@ -33,48 +56,175 @@ class Distribution:
     def set_key_id(self, key_id):
         self.key_id = key_id
 
-    def update(self):
+    @property
+    def index_pairs(self):
+        return [(component, arch) for component in self.components for arch in self.archs]
+
+    def reconfigure(self, architectures: List[str], components: List[str]):
+        """Applies new architectures/components. Indexes of removed ones are deleted, their pool files are kept.
+        Returns the added (component, arch) pairs, which still need to be indexed."""
+        with self.__update_lock__():
+            old_pairs = set(self.index_pairs)
+            removed_components = set(self.components) - set(components)
+            self.archs = [arch for arch in architectures if arch != ARCH_ALL]
+            self.components = list(components)
+            new_pairs = set(self.index_pairs)
+            for component, arch in old_pairs - new_pairs:
+                rmtree(path.join(self.dist_dir, component, f"binary-{arch}"), ignore_errors=True)
+            for component in removed_components:
+                rmtree(path.join(self.dist_dir, component), ignore_errors=True)
+        return [pair for pair in self.index_pairs if pair not in old_pairs]
+
+    def unpublish(self):
+        """Removes the indexes and release files of a dropped distribution. Its pool is kept. on_publish is called
+        afterwards too, so secondaries drop them as well."""
+        with self.__update_lock__():
+            for component in self.components:
+                rmtree(path.join(self.dist_dir, component), ignore_errors=True)
+            for release_file in ("Release", "Release.gpg", "InRelease"):
+                if path.exists(path.join(self.dist_dir, release_file)):
+                    remove(path.join(self.dist_dir, release_file))
+        if self.on_publish is not None:
+            self.on_publish(self)
+
+    def update(self, pairs: List[Tuple[str, str]] = None):
+        """Rescans the pool and regenerates release files. Only the given (component, arch) pairs are rescanned
+        if pairs is set."""
         if self.key_id is None:
             raise Exception('No key id provided!')
         with self.update_wait_mutex:
             if self.queued_update_requests >= 2:
-                log(f"There are already queued updates for {self.name} distribution. Discarded.")
+                log(f"There are already queued updates for {self.name} distribution. Discarded.", level=WARNING)
                 return
             self.queued_update_requests += 1
         log(f"{self.name}: Waiting update lock...")
-        with self.update_mutex:
+        with self.__update_lock__():
             log(f"{self.name}: Acquired lock.")
             log(f"{self.name}: Updating...")
             try:
-                self.__update_packages__()
+                self.__update_packages__(pairs if pairs is not None else self.index_pairs)
                 self.__generate_release_files__()
                 log(f"{self.name}: Updated.")
             except Exception as e:
-                log(f"Error during {self.name} update: {e}")
+                log(f"Error during {self.name} update: {e}", level=ERROR)
                 with self.update_wait_mutex:
                     self.queued_update_requests -= 1
                 raise e
         with self.update_wait_mutex:
             self.queued_update_requests -= 1
+        if self.on_publish is not None:
+            self.on_publish(self)
 
-    def __update_packages__(self):
+    def __prepare_index__(self, component: str, arch: str):
+        pool_path = path.join(self.pool_dir, component, arch)
+        packages_path = path.join(self.dist_dir, component, f"binary-{arch}")
+        makedirs(packages_path, exist_ok=True)
+        makedirs(pool_path, exist_ok=True)
+        if self.sharded_pool:
+            self.__shard_packages__(pool_path)
+        return pool_path, packages_path
+
+    def __update_packages__(self, pairs: List[Tuple[str, str]]):
+        components = sorted({component for component, _ in pairs})
         with ThreadPoolExecutor() as executor:
+            # Architecture: all packages live once in pool/<component>/all. They are scanned once per component
+            # into binary-all, which is then merged into every binary-<arch> index.
+            futures = [executor.submit(self.__process_architecture__, *self.__prepare_index__(component, ARCH_ALL),
+                                       ARCH_ALL) for component in components]
+            for future in futures:
+                future.result()
+
             futures = []
-            for component in self.components:
-                for arch in self.archs:
-                    pool_path = path.join(self.pool_dir, component, arch)
-                    packages_path = path.join(self.dist_dir, component, f"binary-{arch}")
-                    makedirs(packages_path, exist_ok=True)
-                    makedirs(pool_path, exist_ok=True)
-
-                    future = executor.submit(self.__process_architecture__, pool_path, packages_path, arch)
-                    futures.append(future)
+            for component, arch in pairs:
+                pool_path, packages_path = self.__prepare_index__(component, arch)
+                all_packages_path = path.join(self.dist_dir, component, f"binary-{ARCH_ALL}", "Packages")
+                future = executor.submit(self.__process_architecture__, pool_path, packages_path, arch,
+                                         all_packages_path)
+                futures.append(future)
             for future in futures:
                 future.result()
 
-    def __process_architecture__(self, pool_path, packages_path, arch):
+    @staticmethod
+    def __shard_packages__(pool_path, keep_original=False):
+        """Moves (or hard links, if keep_original) packages lying directly in pool_path into
+        <prefix>/<source>/ subdirectories. Returns the paths of the flat files that were handled."""
+        sharded = []
+        for entry in scandir(pool_path):
+            if not entry.is_file() or not entry.name.endswith(PACKAGE_SUFFIXES):
+                continue
+            source_name = get_deb_source_name(entry.path)
+            if source_name is None:
+                continue
+            target_dir = path.join(pool_path, get_pool_shard(source_name))
+            target_path = path.join(target_dir, entry.name)
+            makedirs(target_dir, exist_ok=True)
+            if path.exists(target_path) and path.samefile(entry.path, target_path):
+                pass  # Already linked by a running migration, which removes the flat copy itself.
+            elif keep_original:
+                if path.exists(target_path):
+                    remove(target_path)
+                link(entry.path, target_path)
+            else:
+                replace(entry.path, target_path)
+            sharded.append(entry.path)
+        return sharded
+
+    def migrate_pool(self, grace_period_in_sec=MIGRATION_GRACE_PERIOD_IN_SEC):
+        """Reorganizes a flat pool into the sharded layout while it is being served. Packages are hard linked
+        into their shard and reindexed in one go. Indexes only list the shard path of a linked package, so the
+        flat copies can be removed once clients with the previous indexes had grace_period_in_sec to move on."""
+        with self.__update_lock__():
+            linked = []
+            for component, arch in self.index_pairs + [(component, ARCH_ALL) for component in self.components]:
+                pool_path = path.join(self.pool_dir, component, arch)
+                if path.isdir(pool_path):
+                    linked += self.__shard_packages__(pool_path, keep_original=True)
+            if linked:
+                self.__update_packages__(self.index_pairs)
+                self.__generate_release_files__()
+        if not linked:
+            log(f"{self.name}: Pool is already sharded.")
+            return
+        if self.on_publish is not None:
+            self.on_publish(self)
+        log(f"{self.name}: Published the sharded pool. Removing the flat copies in {grace_period_in_sec}s...")
+        time.sleep(grace_period_in_sec)
+        for flat_path in linked:
+            if path.exists(flat_path):
+                remove(flat_path)
+        log(f"{self.name}: Moved {len(linked)} packages into the sharded pool layout.")
+
+    def __linked_flat_packages__(self, pool_path):
+        """Returns the Filename (relative to debian_dir) of packages lying directly in pool_path that are hard
+        linked into a shard too, i.e. whose migration is in progress."""
+        flat = {}
+        for entry in scandir(pool_path):
+            if entry.is_file() and entry.name.endswith(PACKAGE_SUFFIXES):
+                entry_stat = entry.stat()
+                if entry_stat.st_nlink > 1:
+                    flat[(entry_stat.st_dev, entry_stat.st_ino)] = entry.path
+        if not flat:
+            return set()
+        linked = set()
+        for root, _, files in walk(pool_path):
+            if root == pool_path:
+                continue
+            for f in files:
+                file_stat = stat(path.join(root, f))
+                flat_path = flat.get((file_stat.st_dev, file_stat.st_ino))
+                if flat_path is not None:
+                    linked.add(path.relpath(flat_path, self.debian_dir))
+        return linked
+
+    def __process_architecture__(self, pool_path, packages_path, arch, all_packages_path=None):
         generate_packages_file(self.keyring_dir, path.relpath(pool_path, self.debian_dir), packages_path, arch,
                                self.debian_dir)
+        linked_flat_packages = self.__linked_flat_packages__(pool_path)
+        if linked_flat_packages:
+            # Only the shard path is published, so removing the flat copy never breaks the index.
+            remove_packages_entries(packages_path, linked_flat_packages)
+        if all_packages_path is not None:
+            append_packages_file(packages_path, all_packages_path)
         generate_packages_gz_file(self.keyring_dir, packages_path)
 
     def __generate_release_files__(self):
@@ -97,7 +247,8 @@ class Distribution:
 Suite: {self.name}
 Codename: {self.name}
 Version: 1.0
-Architectures: {" ".join(self.archs)}
+Architectures: {" ".join([ARCH_ALL] + self.archs)}
+No-Support-for-Architecture-all: Packages
 Components: {" ".join(self.components)}
 Description: {self.description}
 Date: {date}
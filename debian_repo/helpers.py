@@ -1,6 +1,7 @@
 from .common import execute_cmd
-from .logger import log
+from .logger import log, ERROR, WARNING
 
+import shlex
 from os import path
 
 
@@ -9,7 +10,7 @@ def generate_release_gpg_file(key_id: str, keyring_dir: str, out_path: str, rele
         f"gpg -abs -u {key_id} --yes -o {out_path} {release_file_path}",
         env={'GNUPGHOME': keyring_dir})
     if rc != 0:
-        log(f"Error while generating {out_path}: {err.decode('utf-8')}")
+        log(f"Error while generating {out_path}: {err.decode('utf-8')}", level=ERROR)
 
 
 def generate_inrelease_file(key_id: str, keyring_dir: str, out_path: str, release_file_path: str):
@@ -17,7 +18,7 @@ def generate_inrelease_file(key_id: str, keyring_dir: str, out_path: str, releas
         f"gpg --clearsign -u {key_id} --yes -o {out_path} {release_file_path}",
         env={'GNUPGHOME': keyring_dir})
     if rc != 0:
-        log(f"Error while generating {out_path}: {err.decode('utf-8')}")
+        log(f"Error while generating {out_path}: {err.decode('utf-8')}", level=ERROR)
 
 
 def generate_packages_file(keyring_dir: str, pool_dir: str, packages_folder: str, arch: str, deb_dir: str):
@@ -26,7 +27,30 @@ def generate_packages_file(keyring_dir: str, pool_dir: str, packages_folder: str
         f"dpkg-scanpackages -m --arch {arch} {pool_dir} > {packages_file_path}",
         env={'GNUPGHOME': keyring_dir}, cwd=deb_dir)
     if rc != 0:
-        log(f"Error while scanning packages: {err.decode('utf-8')}")
+        log(f"Error while scanning packages: {err.decode('utf-8')}", level=ERROR)
+
+
+def append_packages_file(packages_folder: str, extra_packages_file_path: str):
+    """Appends the stanzas of another Packages file, e.g. binary-all's, to packages_folder/Packages."""
+    if not path.exists(extra_packages_file_path):
+        return
+    packages_file_path = path.join(packages_folder, 'Packages')
+    with open(packages_file_path) as f, open(extra_packages_file_path) as extra_file:
+        parts = [part.strip("\n") for part in (f.read(), extra_file.read()) if part.strip()]
+    with open(packages_file_path, 'w') as f:
+        f.write("\n\n".join(parts) + "\n" if parts else "")
+
+
+def remove_packages_entries(packages_folder: str, filenames):
+    """Drops the stanzas whose Filename is in filenames from packages_folder/Packages."""
+    packages_file_path = path.join(packages_folder, 'Packages')
+    with open(packages_file_path) as f:
+        stanzas = [stanza.strip("\n") for stanza in f.read().split("\n\n") if stanza.strip()]
+    kept = [stanza for stanza in stanzas
+            if not any(line[len("Filename: "):] in filenames for line in stanza.splitlines()
+                       if line.startswith("Filename: "))]
+    with open(packages_file_path, 'w') as f:
+        f.write("\n\n".join(kept) + "\n" if kept else "")
 
 
 def generate_packages_gz_file(keyring_dir: str, packages_folder: str):
@@ -35,7 +59,7 @@ def generate_packages_gz_file(keyring_dir: str, packages_folder: str):
     out, err, rc = execute_cmd(f"gzip -9 -c {packages_file_path} > {packages_gz_file_path}",
                                env={'GNUPGHOME': keyring_dir})
     if rc != 0:
-        log(f"Error while zipping package info: {err.decode('utf-8')}")
+        log(f"Error while zipping package info: {err.decode('utf-8')}", level=ERROR)
 
 
 def get_gpg_key_id(keyring_dir: str):
@@ -43,3 +67,21 @@ def get_gpg_key_id(keyring_dir: str):
                                env={'GNUPGHOME': keyring_dir})
 
     return out.decode("utf-8").strip()
+
+
+def get_deb_source_name(deb_path: str):
+    """Returns the source package name of a .deb, falling back to its binary package name."""
+    out, err, rc = execute_cmd(f"dpkg-deb -f {shlex.quote(deb_path)} Source Package")
+    if rc != 0:
+        log(f"Error while reading {deb_path}: {err.decode('utf-8')}", level=WARNING)
+        return None
+    fields = dict(line.split(":", 1) for line in out.decode("utf-8").splitlines() if ":" in line)
+    name = fields.get("Source", fields.get("Package", "")).strip().split(" ")[0]
+    return name or None
+
+
+def get_pool_shard(source_name: str):
+    """Debian pool prefix: first letter, or first four letters for lib* sources (e.g. libs/libssl)."""
+    if source_name.startswith("lib") and len(source_name) > 3:
+        return path.join(source_name[:4], source_name)
+    return path.join(source_name[0], source_name)
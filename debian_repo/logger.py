@@ -1,5 +1,171 @@
+import atexit
+import json
+import os
 import sys
+import time
+from datetime import datetime, timezone
+from queue import Queue, Empty, Full
+from threading import Lock, Thread, current_thread
+from typing import Dict
 
-def log(msg: str):
-    print(msg)
-    sys.stdout.flush()
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: "DEBUG", INFO: "INFO", WARNING: "WARNING", ERROR: "ERROR"}
+LEVELS = {name.lower(): level for level, name in LEVEL_NAMES.items()}
+
+
+class AsyncLogger:
+    """Queue-backed logger. Callers only enqueue, a background thread formats, writes and flushes in batches so
+    request and update threads never block on stdout."""
+
+    def __init__(self, level=INFO, json_format=False, batch_size=256, flush_interval=0.5, max_queue=10000,
+                 summary_interval=5):
+        self.level = level
+        self.json_format = json_format
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.summary_interval = summary_interval
+        self.queue = Queue(maxsize=max_queue)
+        self.dropped = 0
+        self.summaries: Dict[str, list] = {}
+        self.mutex = Lock()
+        self.writer = None
+
+    def reset_after_fork(self):
+        """The writer thread doesn't survive fork, so a forked child starts with a fresh queue and writer."""
+        self.queue = Queue(maxsize=self.queue.maxsize)
+        self.summaries = {}
+        self.dropped = 0
+        self.mutex = Lock()
+        self.writer = None
+
+    def configure(self, level=None, json_format=None):
+        if level is not None:
+            self.level = LEVELS[level.lower()] if isinstance(level, str) else level
+        if json_format is not None:
+            self.json_format = json_format
+
+    def __ensure_writer__(self):
+        if self.writer is None:
+            with self.mutex:
+                if self.writer is None:
+                    self.writer = Thread(target=self.__run__, name="logger", daemon=True)
+                    self.writer.start()
+
+    def log(self, msg: str, level=INFO):
+        if level < self.level:
+            return
+        self.__ensure_writer__()
+        try:
+            self.queue.put_nowait((time.time(), level, current_thread().name, msg))
+        except Full:
+            with self.mutex:
+                self.dropped += 1
+
+    def log_summarized(self, key: str, msg: str, level=INFO):
+        """Logs msg, but repeats with the same key within summary_interval seconds are counted and reported as a
+        single summary line once the interval is over."""
+        if level < self.level:
+            return
+        now = time.monotonic()
+        with self.mutex:
+            summary = self.summaries.get(key)
+            if summary is not None and now - summary[0] < self.summary_interval:
+                summary[1] += 1
+                summary[2] = msg
+                return
+            self.summaries[key] = [now, 0, msg, level]
+        self.log(msg, level)
+
+    def __expired_summaries__(self, force=False):
+        now = time.monotonic()
+        lines = []
+        with self.mutex:
+            for key, (started, count, msg, level) in list(self.summaries.items()):
+                if force or now - started >= self.summary_interval:
+                    del self.summaries[key]
+                    if count > 0:
+                        lines.append((time.time(), level, "logger",
+                                      f"{msg} (and {count} similar in the last {self.summary_interval}s)"))
+            if self.dropped:
+                lines.append((time.time(), WARNING, "logger", f"Dropped {self.dropped} log messages."))
+                self.dropped = 0
+        return lines
+
+    def __format_record__(self, record):
+        timestamp, level, thread_name, msg = record
+        if self.json_format:
+            return json.dumps({"time": datetime.fromtimestamp(timestamp, timezone.utc).isoformat(),
+                               "level": LEVEL_NAMES[level].lower(), "thread": thread_name, "message": msg})
+        if level == INFO:
+            return msg
+        return f"{LEVEL_NAMES[level]}: {msg}"
+
+    def __write__(self, records):
+        if not records:
+            return
+        stream = sys.stdout
+        stream.write("".join(self.__format_record__(record) + "\n" for record in records))
+        stream.flush()
+
+    def __drain__(self, first=None):
+        records = [] if first is None else [first]
+        while len(records) < self.batch_size:
+            try:
+                records.append(self.queue.get_nowait())
+            except Empty:
+                break
+        try:
+            self.__write__(records)
+        finally:
+            for _ in records:
+                self.queue.task_done()
+
+    def __run__(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=self.flush_interval)
+            except Empty:
+                first = None
+            try:
+                self.__drain__(first)
+                self.__write__(self.__expired_summaries__())
+            except Exception as e:
+                sys.stderr.write(f"Logger error: {e}\n")
+
+    def flush(self):
+        """Blocks until everything logged so far, including pending summaries, has been written."""
+        pending = self.__expired_summaries__(force=True)
+        if pending:
+            self.__ensure_writer__()
+        for record in pending:
+            try:
+                self.queue.put_nowait(record)
+            except Full:
+                break
+        if self.writer is not None:
+            self.queue.join()
+
+
+logger = AsyncLogger()
+atexit.register(logger.flush)
+os.register_at_fork(after_in_child=logger.reset_after_fork)
+
+
+def log(msg: str, level=INFO):
+    logger.log(msg, level)
+
+
+def log_summarized(key: str, msg: str, level=INFO):
+    logger.log_summarized(key, msg, level)
+
+
+def configure_logger(level="info", json_format=False):
+    logger.configure(level=level, json_format=json_format)
+
+
+def flush_logs():
+    logger.flush()
@@ -0,0 +1,301 @@
+import fcntl
+import os
+import posixpath
+import tempfile
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from email.utils import formatdate, parsedate_to_datetime
+from threading import Condition, Lock, Thread
+from typing import Dict
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from .logger import log, WARNING
+
+CHUNK_SIZE = 64 * 1024
+# Worker processes share the cache directory. The lock file holds the cache size they all add to, and serializes
+# eviction between them.
+LOCK_FILE = ".proxy.lock"
+# Eviction frees space down to this fraction of the limit, so the directory rescan it needs is rare rather than
+# happening on every fetch once the cache is full.
+EVICTION_LOW_WATERMARK = 0.9
+IMMUTABLE_SUFFIXES = (".deb", ".udeb", ".ddeb", ".dsc", ".diff.gz", ".tar.gz", ".tar.xz", ".tar.bz2", ".tar.zst")
+
+
+def is_immutable(rel_path: str):
+    """Pool files and by-hash indexes never change once published, everything else must be revalidated."""
+    return "/by-hash/" in rel_path or ("pool/" in rel_path and rel_path.endswith(IMMUTABLE_SUFFIXES))
+
+
+class UpstreamFetch:
+    """A single in-flight upstream download. Any number of readers can stream the file while it is being written."""
+
+    def __init__(self, url: str, tmp_path: str, if_modified_since=None):
+        self.url = url
+        self.tmp_path = tmp_path
+        self.if_modified_since = if_modified_since
+        self.status = None
+        self.content_length = None
+        self.last_modified = None
+        self.written = 0
+        self.done = False
+        self.condition = Condition()
+
+    def run(self, timeout: int):
+        headers = {}
+        if self.if_modified_since is not None:
+            headers["If-Modified-Since"] = formatdate(self.if_modified_since, usegmt=True)
+        try:
+            with urlopen(Request(self.url, headers=headers), timeout=timeout) as response, \
+                    open(self.tmp_path, "wb") as f:
+                with self.condition:
+                    self.status = response.status
+                    length = response.headers.get("Content-Length")
+                    self.content_length = int(length) if length is not None else None
+                    self.last_modified = response.headers.get("Last-Modified")
+                    self.condition.notify_all()
+                for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                    f.write(chunk)
+                    f.flush()
+                    with self.condition:
+                        self.written += len(chunk)
+                        self.condition.notify_all()
+        except HTTPError as e:
+            with self.condition:
+                self.status = e.code
+        except Exception as e:
+            log(f"Proxy: fetching {self.url} failed: {e}", level=WARNING)
+            with self.condition:
+                self.status = 502
+        with self.condition:
+            if self.status == 200 and self.content_length is not None and self.written != self.content_length:
+                log(f"Proxy: truncated response for {self.url}", level=WARNING)
+                self.status = 502
+            self.done = True
+            self.condition.notify_all()
+
+    def wait_for_status(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.status is not None or self.done)
+            return self.status
+
+    @property
+    def complete(self):
+        return self.done and self.status == 200
+
+
+class FetchReader:
+    """File-like object reading an UpstreamFetch's temp file, blocking until more bytes arrive."""
+
+    def __init__(self, fetch: UpstreamFetch):
+        self.fetch = fetch
+        self.file = open(fetch.tmp_path, "rb")
+        self.position = 0
+
+    def read(self, size=CHUNK_SIZE):
+        with self.fetch.condition:
+            self.fetch.condition.wait_for(lambda: self.fetch.written > self.position or self.fetch.done)
+            available = self.fetch.written - self.position
+        if available <= 0:
+            return b""
+        data = self.file.read(min(size, available))
+        self.position += len(data)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class ProxyCache:
+    """Pull-through cache for upstream apt repositories, served under /<prefix>/ for each configured upstream."""
+
+    def __init__(self, cache_dir: str, upstreams: Dict[str, str], max_size_in_mb=10240, index_ttl_in_sec=300,
+                 timeout=30):
+        self.cache_dir = cache_dir
+        self.upstreams = {prefix.strip("/"): url.rstrip("/") for prefix, url in upstreams.items()}
+        self.max_size = max_size_in_mb * 1024 * 1024
+        self.index_ttl = index_ttl_in_sec
+        self.timeout = timeout
+        self.mutex = Lock()
+        self.in_flight: Dict[str, UpstreamFetch] = {}
+        self.validated_at: Dict[str, float] = {}
+        self.lru: OrderedDict = OrderedDict()
+        self.total_size = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def load(self):
+        """Removes partial downloads of a previous run and loads the cache index. Only the serving process may call
+        it: a --migrate-pool run next to a live server would delete that server's in-flight downloads."""
+        with self.__lock_shared_size__() as fd:
+            self.__scan__(remove_partial=True)
+            self.__write_shared_size__(fd)
+        log(f"Proxy cache: {len(self.lru)} files, {self.total_size // (1024 * 1024)} MB.")
+
+    def __scan__(self, remove_partial=False):
+        """Rebuilds the LRU list and total size from the cache directory, ordered by access time. Other worker
+        processes add, touch and evict files too, so the directory is the only accurate record."""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for f in files:
+                file_path = os.path.join(root, f)
+                if f.startswith(".proxy"):
+                    if remove_partial and f.startswith(".proxy-"):
+                        os.remove(file_path)
+                    continue
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_atime, os.path.relpath(file_path, self.cache_dir), stat.st_size))
+        self.lru = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.total_size = sum(self.lru.values())
+
+    @contextmanager
+    def __lock_shared_size__(self):
+        fd = os.open(os.path.join(self.cache_dir, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            yield fd
+        finally:
+            os.close(fd)
+
+    def __write_shared_size__(self, fd: int):
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, str(self.total_size).encode("ascii"), 0)
+
+    def __add_to_shared_size__(self, delta: int):
+        """Must be called with self.mutex held. Adds delta to the size shared by all workers and evicts if the cache
+        is over its limit. Only then the directory is rescanned to pick up the other workers' files."""
+        with self.__lock_shared_size__() as fd:
+            try:
+                self.total_size = int(os.pread(fd, 32, 0) or b"0") + delta
+            except ValueError:
+                self.total_size = self.max_size + 1
+            if self.total_size > self.max_size:
+                self.__scan__()
+                self.__evict__(int(self.max_size * EVICTION_LOW_WATERMARK))
+            self.__write_shared_size__(fd)
+
+    def match(self, request_path: str):
+        """Returns the cache key for a proxied request path, or None if it doesn't belong to any upstream."""
+        path = request_path.split("?", 1)[0].split("#", 1)[0].lstrip("/")
+        prefix, _, rel_path = path.partition("/")
+        if prefix not in self.upstreams or not rel_path or rel_path.endswith("/"):
+            return None
+        normalized = posixpath.normpath(rel_path)
+        if normalized.startswith("..") or normalized.startswith("/"):
+            return None
+        return f"{prefix}/{normalized}"
+
+    def __cached_path__(self, key: str):
+        return os.path.join(self.cache_dir, key)
+
+    def __upstream_url__(self, key: str):
+        prefix, _, rel_path = key.partition("/")
+        return f"{self.upstreams[prefix]}/{rel_path}"
+
+    def __is_fresh__(self, key: str):
+        if not os.path.exists(self.__cached_path__(key)):
+            return False
+        if is_immutable(key):
+            return True
+        return time.monotonic() - self.validated_at.get(key, float("-inf")) < self.index_ttl
+
+    def __touch__(self, key: str):
+        with self.mutex:
+            if key in self.lru:
+                self.lru.move_to_end(key)
+        try:
+            cached_path = self.__cached_path__(key)
+            os.utime(cached_path, (time.time(), os.path.getmtime(cached_path)))
+        except OSError:
+            pass
+
+    def __start_fetch__(self, key: str):
+        """Must be called with self.mutex held. Joins the in-flight fetch for key or starts a new one."""
+        fetch = self.in_flight.get(key)
+        if fetch is not None:
+            return fetch
+        cached_path = self.__cached_path__(key)
+        os.makedirs(os.path.dirname(cached_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".proxy-", dir=os.path.dirname(cached_path))
+        os.close(fd)
+        if_modified_since = os.path.getmtime(cached_path) if os.path.exists(cached_path) else None
+        fetch = UpstreamFetch(self.__upstream_url__(key), tmp_path, if_modified_since)
+        self.in_flight[key] = fetch
+        Thread(target=self.__run_fetch__, args=(key, fetch), daemon=True).start()
+        return fetch
+
+    def __run_fetch__(self, key: str, fetch: UpstreamFetch):
+        fetch.run(self.timeout)
+        cached_path = self.__cached_path__(key)
+        with self.mutex:
+            try:
+                if fetch.complete:
+                    if fetch.last_modified:
+                        try:
+                            mtime = parsedate_to_datetime(fetch.last_modified).timestamp()
+                            os.utime(fetch.tmp_path, (time.time(), mtime))
+                        except (TypeError, ValueError):
+                            pass
+                    os.replace(fetch.tmp_path, cached_path)
+                    delta = fetch.written - self.lru.pop(key, 0)
+                    self.lru[key] = fetch.written
+                    self.validated_at[key] = time.monotonic()
+                    self.__add_to_shared_size__(delta)
+                elif fetch.status == 304:
+                    self.validated_at[key] = time.monotonic()
+            except OSError as e:
+                log(f"Proxy: caching {key} failed: {e}", level=WARNING)
+            finally:
+                # Later requests must start a new fetch instead of joining this one, even if caching failed.
+                del self.in_flight[key]
+                try:
+                    os.remove(fetch.tmp_path)
+                except FileNotFoundError:
+                    pass
+
+    def __evict__(self, target_size: int):
+        """Must be called with self.mutex and the shared size lock held. Drops least recently used files until the
+        cache is down to target_size. Files that are being fetched are skipped, so it can stop above it."""
+        for key, size in list(self.lru.items()):
+            if self.total_size <= target_size:
+                break
+            if key in self.in_flight:
+                continue
+            try:
+                os.remove(self.__cached_path__(key))
+            except FileNotFoundError:
+                pass
+            del self.lru[key]
+            self.validated_at.pop(key, None)
+            self.total_size -= size
+
+    def open(self, key: str):
+        """Returns (status, content length, file-like object). The file object is None unless status is 200."""
+        # A cached file can be evicted, possibly by another worker, between the freshness check and opening it. It
+        # is then fetched from upstream again instead of failing the request.
+        for _ in range(2):
+            reader = None
+            fetch = None
+            with self.mutex:
+                if not self.__is_fresh__(key):
+                    fetch = self.__start_fetch__(key)
+                    reader = FetchReader(fetch)
+            if fetch is not None:
+                status = fetch.wait_for_status()
+                if status == 200:
+                    return 200, fetch.content_length, reader
+                reader.close()
+                if (status != 304 and status != 502) or not os.path.exists(self.__cached_path__(key)):
+                    return status, None, None
+                if status == 502:
+                    log(f"Proxy: upstream unavailable, serving stale {key}", level=WARNING)
+            self.__touch__(key)
+            try:
+                cached = open(self.__cached_path__(key), "rb")
+            except FileNotFoundError:
+                continue
+            return 200, os.fstat(cached.fileno()).st_size, cached
+        return 404, None, None
@@ -0,0 +1,262 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+from http.client import HTTPConnection, HTTPSConnection
+from threading import Condition, Lock, Thread
+from typing import Dict, List, Tuple
+from urllib.parse import urlparse, quote
+
+from .logger import log, ERROR
+
+REPLICATION_PATH = "/.replication"
+TOKEN_HEADER = "X-Replication-Token"
+SHA256_HEADER = "X-Content-SHA256"
+RELEASE_FILES = ("Release", "Release.gpg", "InRelease")
+CHUNK_SIZE = 64 * 1024
+RETRY_BACKOFF_IN_SEC = 5
+MAX_RETRY_BACKOFF_IN_SEC = 300
+
+
+class ReplicationError(Exception):
+    pass
+
+
+def file_sha256(file_path: str):
+    sha256 = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def safe_join(root_dir: str, rel_path: str):
+    """Joins a replicated relative path onto root_dir, refusing anything that escapes it."""
+    full_path = os.path.realpath(os.path.join(root_dir, rel_path))
+    root = os.path.realpath(root_dir)
+    if os.path.isabs(rel_path) or not full_path.startswith(root + os.sep):
+        raise ReplicationError(f"Invalid replication path: {rel_path}")
+    return full_path
+
+
+class ManifestBuilder:
+    """Builds {relative path: [sha256, size]} manifests. Hashes are cached by (size, mtime) so unchanged pool
+    files are not re-read for every published generation."""
+
+    def __init__(self, root_dir: str):
+        self.root_dir = root_dir
+        self.cache: Dict[str, Tuple[int, int, str]] = {}
+        self.mutex = Lock()
+
+    def build(self, prefixes: List[str]):
+        manifest = {}
+        for prefix in prefixes:
+            prefix_path = safe_join(self.root_dir, prefix)
+            if os.path.isfile(prefix_path):
+                candidates = [prefix_path]
+            else:
+                candidates = [os.path.join(root, f) for root, _, files in os.walk(prefix_path) for f in files]
+            for file_path in candidates:
+                if os.path.basename(file_path).startswith(".replication-"):
+                    continue
+                rel_path = os.path.relpath(file_path, self.root_dir)
+                entry = self.__entry__(file_path)
+                if entry is not None:
+                    manifest[rel_path] = entry
+        return manifest
+
+    def __entry__(self, file_path: str):
+        try:
+            stat = os.stat(file_path)
+        except FileNotFoundError:
+            return None
+        with self.mutex:
+            cached = self.cache.get(file_path)
+        if cached is not None and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return [cached[2], stat.st_size]
+        sha256 = file_sha256(file_path)
+        with self.mutex:
+            self.cache[file_path] = (stat.st_size, stat.st_mtime_ns, sha256)
+        return [sha256, stat.st_size]
+
+
+def diff_manifests(remote: Dict, local: Dict):
+    """Returns (paths to send, paths to delete) to turn the remote manifest into the local one."""
+    changed = [p for p, entry in local.items() if remote.get(p) != entry]
+    removed = [p for p in remote if p not in local]
+    return changed, removed
+
+
+def transfer_order(rel_path: str):
+    """Sort key: pool files first, then indexes, then Release files so a mirror never references missing files."""
+    if os.path.basename(rel_path) in RELEASE_FILES:
+        return 2, rel_path
+    if "/pool/" in f"/{rel_path}":
+        return 0, rel_path
+    return 1, rel_path
+
+
+class DirectoryTarget:
+    """Secondary that is a local directory, i.e. the repo_dir of another instance on the same host."""
+
+    def __init__(self, target_dir: str):
+        self.target_dir = target_dir
+        self.manifest_builder = ManifestBuilder(target_dir)
+
+    def __str__(self):
+        return self.target_dir
+
+    def fetch_manifest(self, prefixes: List[str]):
+        return self.manifest_builder.build(prefixes)
+
+    def put(self, rel_path: str, source_path: str, sha256: str):
+        target_path = safe_join(self.target_dir, rel_path)
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".replication-", dir=os.path.dirname(target_path))
+        try:
+            with os.fdopen(fd, "wb") as tmp, open(source_path, "rb") as src:
+                shutil.copyfileobj(src, tmp, CHUNK_SIZE)
+            if file_sha256(tmp_path) != sha256:
+                raise ReplicationError(f"Checksum mismatch while copying {rel_path}")
+            os.replace(tmp_path, target_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def delete(self, rel_path: str):
+        target_path = safe_join(self.target_dir, rel_path)
+        if os.path.exists(target_path):
+            os.remove(target_path)
+
+
+class HttpTarget:
+    """Secondary that is another debianrepo instance running in mirror mode."""
+
+    def __init__(self, url: str, token: str, timeout=60):
+        self.url = urlparse(url)
+        self.token = token
+        self.timeout = timeout
+
+    def __str__(self):
+        return self.url.geturl()
+
+    def __connection__(self):
+        if self.url.scheme == "https":
+            return HTTPSConnection(self.url.netloc, timeout=self.timeout)
+        return HTTPConnection(self.url.netloc, timeout=self.timeout)
+
+    def __request__(self, method: str, rel_path: str, body=None, headers=None):
+        all_headers = {TOKEN_HEADER: self.token}
+        all_headers.update(headers or {})
+        base_path = self.url.path.rstrip("/")
+        conn = self.__connection__()
+        try:
+            conn.request(method, f"{base_path}{REPLICATION_PATH}/{quote(rel_path)}", body=body, headers=all_headers)
+            response = conn.getresponse()
+            data = response.read()
+            if response.status >= 300:
+                raise ReplicationError(f"{method} {rel_path} on {self} failed: {response.status} {data[:200]!r}")
+            return data
+        finally:
+            conn.close()
+
+    def fetch_manifest(self, prefixes: List[str]):
+        data = self.__request__("POST", "manifest", body=json.dumps(prefixes).encode("utf-8"),
+                                headers={"Content-Type": "application/json"})
+        return json.loads(data.decode("utf-8"))
+
+    def put(self, rel_path: str, source_path: str, sha256: str):
+        with open(source_path, "rb") as f:
+            self.__request__("PUT", rel_path, body=f, headers={SHA256_HEADER: sha256,
+                                                               "Content-Length": str(os.path.getsize(source_path))})
+
+    def delete(self, rel_path: str):
+        self.__request__("DELETE", rel_path)
+
+
+def create_target(secondary: str, token: str):
+    if secondary.startswith("http://") or secondary.startswith("https://"):
+        return HttpTarget(secondary, token)
+    return DirectoryTarget(secondary)
+
+
+class TargetWorker:
+    """Pushes to a single target from a background thread. Generations published while a push is running are
+    coalesced into one follow-up push, and a failed push is retried with backoff."""
+
+    def __init__(self, replicator, target):
+        self.replicator = replicator
+        self.target = target
+        self.pending = set()
+        self.busy = False
+        self.condition = Condition()
+        self.thread = None
+
+    def schedule(self, prefixes: List[str]):
+        with self.condition:
+            self.pending.update(prefixes)
+            if self.thread is None:
+                self.thread = Thread(target=self.__run__, name=f"replication-{self.target}", daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def wait_idle(self, timeout=None):
+        with self.condition:
+            return self.condition.wait_for(lambda: not self.pending and not self.busy, timeout)
+
+    def __run__(self):
+        backoff = 0
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                prefixes = sorted(self.pending)
+                self.pending.clear()
+                self.busy = True
+            try:
+                self.replicator.push_to_target(self.target, prefixes)
+                backoff = 0
+            except Exception as e:
+                backoff = min(max(backoff * 2, RETRY_BACKOFF_IN_SEC), MAX_RETRY_BACKOFF_IN_SEC)
+                log(f"Replication to {self.target} failed, retrying in {backoff}s: {e}", level=ERROR)
+                time.sleep(backoff)
+                with self.condition:
+                    self.pending.update(prefixes)
+            finally:
+                with self.condition:
+                    self.busy = False
+                    self.condition.notify_all()
+
+
+class Replicator:
+    """Pushes published generations from the primary's repo_dir to the configured secondaries. push() only
+    schedules the transfer, so a slow or dead secondary never holds up indexing."""
+
+    def __init__(self, source_dir: str, targets: List):
+        self.source_dir = source_dir
+        self.targets = targets
+        self.manifest_builder = ManifestBuilder(source_dir)
+        self.workers = [TargetWorker(self, target) for target in targets]
+
+    def push(self, prefixes: List[str]):
+        for worker in self.workers:
+            worker.schedule(prefixes)
+
+    def wait_idle(self, timeout=None):
+        """Blocks until every scheduled push has been attempted."""
+        return all([worker.wait_idle(timeout) for worker in self.workers])
+
+    def push_to_target(self, target, prefixes: List[str]):
+        local = self.manifest_builder.build(prefixes)
+        remote = target.fetch_manifest(prefixes)
+        changed, removed = diff_manifests(remote, local)
+        if not changed and not removed:
+            return
+        for rel_path in sorted(changed, key=transfer_order):
+            target.put(rel_path, os.path.join(self.source_dir, rel_path), local[rel_path][0])
+        # Deletions go last so the new indexes are already live when old pool files disappear.
+        for rel_path in sorted(removed, key=transfer_order, reverse=True):
+            target.delete(rel_path)
+        log(f"Replicated {', '.join(prefixes)} to {target}: {len(changed)} sent, {len(removed)} removed.")
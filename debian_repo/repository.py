@@ -2,22 +2,32 @@ from .backup import BackupManager
 from .common import execute_cmd
 from .distribution import Distribution
 from .helpers import get_gpg_key_id
-from .logger import log
-from .server import ThreadedHTTPServer, AuthHandler
-
+from .logger import log, configure_logger, ERROR, WARNING
+from .proxy import ProxyCache
+from .replication import Replicator, create_target
+from .server import ThreadedHTTPServer, ReusePortHTTPServer, AuthHandler, parse_trusted_proxies
+from .throttle import Throttle
+from .workers import WorkerPool
+
+import json
 import os
+import signal
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Event, Thread
+from threading import Event, Lock, Thread
 from typing import Dict
 
 stop_threads = Event()
 
+# Settings that are only read at startup. Changing them in the configuration file needs a restart.
+RESTART_ONLY_SETTINGS = ["replication", "proxy", "throttle", "backup", "log"]
+RESTART_ONLY_HTTP_SETTINGS = ["port", "workers"]
+
 
 def run_with_exception_handling(target_fn, stop_threads_event, httpd):
     try:
         target_fn()
     except Exception as e:
-        log(f"Exception in thread: {e}")
+        log(f"Exception in thread: {e}", level=ERROR)
         stop_threads_event.set()
         httpd.shutdown()
         httpd.server_close()
@@ -25,15 +35,39 @@ def run_with_exception_handling(target_fn, stop_threads_event, httpd):
 
 
 class DebianRepository:
-    def __init__(self, config: Dict, repo_dir: str, no_watch=True) -> None:
+    def __init__(self, config: Dict, repo_dir: str, no_watch=True, config_path=None) -> None:
         self.conf = config
         self.dir = repo_dir
+        # start() changes into repo_dir, so a relative path would no longer point at the file on reload.
+        self.config_path = os.path.realpath(config_path) if config_path is not None else None
+        self.reload_mutex = Lock()
+        self.watcher = None
+        self.worker_pool = None
+        self.trusted_proxies = parse_trusted_proxies(config["http_server"]["trusted_proxies"]
+                                                     if "trusted_proxies" in config["http_server"] else [])
+        if "log" in config:
+            configure_logger(level=config["log"]["level"] if "level" in config["log"] else "info",
+                             json_format=config["log"]["format"] == "json" if "format" in config["log"] else False)
+        self.mirror_mode = False
+        self.replication_token = None
+        self.replicator = None
+        if "replication" in config:
+            replication = config["replication"]
+            mode = replication["mode"] if "mode" in replication else "primary"
+            if mode == "mirror":
+                log("Mirror mode enabled. Repository is read-only and updated by its primary.")
+                self.mirror_mode = True
+                self.replication_token = replication["token"]
+            elif mode == "primary":
+                secondaries = replication["secondaries"] if "secondaries" in replication else []
+                token = replication["token"] if "token" in replication else None
+                log(f"Replicating to {len(secondaries)} secondaries.")
+                self.replicator = Replicator(self.dir, [create_target(s, token) for s in secondaries])
+            else:
+                raise ValueError(f"Replication mode must be 'primary' or 'mirror'! Given: {mode}")
         self.dists: Dict[str, Distribution] = {}
         for dist_name in config["dists"].keys():
-            dist_dir = os.path.join(self.dists_dir, dist_name)
-            self.dists[dist_name] = Distribution(dist_name, dist_dir, config["architectures"],
-                                                 config["dists"][dist_name]["components"], self.keyring_dir,
-                                                 self.debian_dir, config["description"])
+            self.dists[dist_name] = self.__create_distribution__(dist_name, config)
         self.no_watch = no_watch
         if "backup" in config and "enable" in config["backup"] and config["backup"]["enable"]:
             log("Backup enabled.")
@@ -47,11 +81,52 @@ class DebianRepository:
         else:
             log("Backup disabled.")
             self.backup_manager = None
+        if "proxy" in config and "upstreams" in config["proxy"] and config["proxy"]["upstreams"]:
+            proxy_conf = config["proxy"]
+            log(f"Proxying upstreams: {', '.join(proxy_conf['upstreams'])}")
+            self.proxy = ProxyCache(
+                cache_dir=proxy_conf["cache_dir"] if "cache_dir" in proxy_conf else os.path.join(self.root_dir,
+                                                                                                 "proxy_cache"),
+                upstreams=proxy_conf["upstreams"],
+                max_size_in_mb=proxy_conf["max_size"] if "max_size" in proxy_conf else 10240,
+                index_ttl_in_sec=proxy_conf["index_ttl"] if "index_ttl" in proxy_conf else 300)
+        else:
+            self.proxy = None
+        if "throttle" in config:
+            throttle_conf = config["throttle"]
+            self.throttle = Throttle(
+                requests_per_sec=throttle_conf["requests_per_second"] if "requests_per_second" in throttle_conf else 0,
+                request_burst=throttle_conf["request_burst"] if "request_burst" in throttle_conf else 0,
+                bytes_per_sec=(throttle_conf["bandwidth"] if "bandwidth" in throttle_conf else 0) * 1024,
+                bandwidth_burst=(throttle_conf["bandwidth_burst"] if "bandwidth_burst" in throttle_conf else 0) * 1024,
+                total_bytes_per_sec=(throttle_conf["total_bandwidth"] if "total_bandwidth" in throttle_conf
+                                     else 0) * 1024,
+                max_keys=throttle_conf["max_clients"] if "max_clients" in throttle_conf else 10000)
+        else:
+            self.throttle = None
 
     @property
     def port(self):
         return int(self.conf["http_server"]["port"])
 
+    def __create_distribution__(self, dist_name: str, config: Dict):
+        dist_dir = os.path.join(self.dists_dir, dist_name)
+        return Distribution(dist_name, dist_dir, config["architectures"], config["dists"][dist_name]["components"],
+                            self.keyring_dir, self.debian_dir, config["description"],
+                            on_publish=self.replicate_dist if self.replicator else None,
+                            sharded_pool=self.sharded_pool)
+
+    @property
+    def sharded_pool(self):
+        layout = self.conf["pool_layout"] if "pool_layout" in self.conf else "flat"
+        if layout not in ("flat", "sharded"):
+            raise ValueError(f"Pool layout must be 'flat' or 'sharded'! Given: {layout}")
+        return layout == "sharded"
+
+    @property
+    def workers(self):
+        return int(self.conf["http_server"]["workers"]) if "workers" in self.conf["http_server"] else 1
+
     @property
     def root_dir(self):
         return os.path.dirname(self.dir)
@@ -90,27 +165,38 @@ class DebianRepository:
             list(executor.map(lambda dist: dist.create_pool_directory(), self.dists.values()))
 
     def start(self):
-        """Starts HTTP server and package pool watching. Generates GPG key automatically if it doesn't exist."""
-        self.create_pool_directories()
+        """Starts HTTP server and package pool watching. Generates GPG key automatically if it doesn't exist.
+        In mirror mode, only serves the files pushed by the primary."""
+        os.makedirs(self.dir, exist_ok=True)
+        if not self.mirror_mode:
+            self.create_pool_directories()
+        if self.proxy is not None:
+            self.proxy.load()
         os.chdir(self.dir)
 
-        if not self.gpg_key_ok:
-            self.generate_gpg()
+        if not self.mirror_mode:
+            if not self.gpg_key_ok:
+                self.generate_gpg()
 
-        if not self.public_key_ok:
-            self.generate_publickey()
+            if not self.public_key_ok:
+                self.generate_publickey()
 
         self.__generate_connection_guide__()
-        self.update_all_dists()
-
-        server_address = ('', self.port)
-        httpd = ThreadedHTTPServer(server_address,
-                                   lambda *args, **kwargs: AuthHandler(*args, auth=self.conf["http_server"]["auth"],
-                                                                       users=self.conf["http_server"]["users"],
-                                                                       **kwargs))
-        log(f"Serving directory '{self.dir}' on port {self.port} ...")
+        if not self.mirror_mode:
+            self.update_all_dists()
+
+        if self.workers > 1:
+            httpd = WorkerPool(self.workers, stop_threads,
+                               lambda throttle: self.create_http_server(ReusePortHTTPServer, throttle),
+                               throttle=self.throttle, on_reload=self.reload_http_config)
+            self.worker_pool = httpd
+        else:
+            httpd = self.create_http_server(ThreadedHTTPServer, self.throttle)
+        log(f"Serving directory '{self.dir}' on port {self.port} with {self.workers} worker(s) ...")
+        if self.config_path is not None:
+            signal.signal(signal.SIGHUP, lambda *args: Thread(target=self.reload_config).start())
         try:
-            if not self.no_watch:
+            if not self.no_watch and not self.mirror_mode:
                 watch_thread = Thread(target=lambda: run_with_exception_handling(self.watch_pools, stop_threads, httpd))
                 watch_thread.start()
 
@@ -126,11 +212,22 @@ class DebianRepository:
             httpd.shutdown()
             httpd.server_close()
         except Exception as e:
-            log(f"Error: {e}")
+            log(f"Error: {e}", level=ERROR)
             stop_threads.set()
             httpd.shutdown()
             httpd.server_close()
 
+    def create_http_server(self, server_class, throttle):
+        server_address = ('', self.port)
+        return server_class(server_address,
+                            lambda *args, **kwargs: AuthHandler(*args, auth=self.conf["http_server"]["auth"],
+                                                                users=self.conf["http_server"]["users"],
+                                                                replication_token=self.replication_token,
+                                                                proxy=self.proxy,
+                                                                throttle=throttle,
+                                                                trusted_proxies=self.trusted_proxies,
+                                                                **kwargs))
+
     def generate_gpg(self):
         """Generates GPS key for signing repository."""
         os.makedirs(self.dir, exist_ok=True)
@@ -167,9 +264,15 @@ class DebianRepository:
             env={'GNUPGHOME': self.keyring_dir})
 
         if rc != 0:
-            log(f"Error while generating public key: {err.decode('utf-8')}")
+            log(f"Error while generating public key: {err.decode('utf-8')}", level=ERROR)
+
+    def replicate_dist(self, dist: Distribution):
+        """Pushes a freshly published or unpublished distribution (and the public key) to the secondaries."""
+        self.replicator.push(["publickey.gpg", os.path.relpath(dist.dist_dir, self.dir)])
 
     def update_dist(self, dist):
+        if dist not in self.dists:  # Removed by a configuration reload.
+            return
         self.dists[dist].update()
 
     def update_all_dists(self):
@@ -185,6 +288,25 @@ class DebianRepository:
                 except Exception as exc:
                     log(f'{dist} generated an exception: {exc}')
 
+    def migrate_pools(self):
+        """Moves every dist's flat pool into the sharded layout. Safe to run while the server is running, updates
+        are serialized with the server's through each dist's lock file."""
+        if not self.sharded_pool:
+            log("Set \"pool_layout\": \"sharded\" in the configuration so new packages are sharded too.",
+                level=WARNING)
+        key_id = get_gpg_key_id(self.keyring_dir)
+        for dist in self.dists.values():
+            dist.set_key_id(key_id)
+            dist.sharded_pool = True
+        # In parallel, so the dists wait out their grace periods together.
+        with ThreadPoolExecutor() as executor:
+            futures = {executor.submit(dist.migrate_pool): dist for dist in self.dists.values()}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as exc:
+                    log(f'{futures[future].name} generated an exception: {exc}', level=ERROR)
+
     def watch_pools(self):
         """Watch package pool directories for any event (file create, delete, modify, move). Calls EventHandler's functions in case of events."""
         from .watcher import Watcher
@@ -193,9 +315,110 @@ class DebianRepository:
         for dist_name, dist in self.dists.items():
             pool_paths.append(dist.pool_dir)
 
-        watcher = Watcher(stop_event=stop_threads, onupdate=self.update_dist, directories=pool_paths)
+        self.watcher = Watcher(stop_event=stop_threads, onupdate=self.update_dist, directories=pool_paths)
+
+        self.watcher.start()
+
+    def __read_config_file__(self):
+        if self.config_path is None:
+            log("No configuration file to reload from.", level=WARNING)
+            return None
+        try:
+            with open(self.config_path) as config_file:
+                return json.load(config_file)
+        except (OSError, ValueError) as e:
+            log(f"Couldn't reload configuration from {self.config_path}: {e}", level=ERROR)
+            return None
+
+    def reload_http_config(self, new_conf=None):
+        """Applies HTTP users, auth and trusted proxy changes in place. Running requests keep their settings, new
+        requests use the new ones."""
+        new_conf = new_conf if new_conf is not None else self.__read_config_file__()
+        if new_conf is None:
+            return
+        http_conf = self.conf["http_server"]
+        new_http_conf = new_conf["http_server"]
+        if "users" in new_http_conf:
+            http_conf["users"] = new_http_conf["users"]
+        if "auth" in new_http_conf:
+            http_conf["auth"] = new_http_conf["auth"]
+        try:
+            self.trusted_proxies = parse_trusted_proxies(new_http_conf["trusted_proxies"]
+                                                         if "trusted_proxies" in new_http_conf else [])
+        except ValueError as e:
+            log(f"Invalid 'http_server.trusted_proxies', keeping the previous ones: {e}", level=ERROR)
+
+    def reload_config(self):
+        """Re-reads the configuration file (on SIGHUP) and applies it to the running repository: users are updated
+        in place, only added dists/components/architectures are indexed, removed ones are unpublished."""
+        with self.reload_mutex:
+            new_conf = self.__read_config_file__()
+            if new_conf is None:
+                return
+            log(f"Reloading configuration from {self.config_path} ...")
+            for key in RESTART_ONLY_SETTINGS:
+                if new_conf.get(key) != self.conf.get(key):
+                    log(f"Changes to '{key}' need a restart. Ignored.", level=WARNING)
+            for key in RESTART_ONLY_HTTP_SETTINGS:
+                if new_conf["http_server"].get(key) != self.conf["http_server"].get(key):
+                    log(f"Changes to 'http_server.{key}' need a restart. Ignored.", level=WARNING)
+
+            self.reload_http_config(new_conf)
+            if self.worker_pool is not None:
+                self.worker_pool.reload()
+            if not self.mirror_mode:
+                self.__reload_pool_layout__(new_conf)
+                self.__reload_dists__(new_conf)
+            for key in ["dists", "architectures", "description", "short_name", "name", "email"]:
+                if key in new_conf:
+                    self.conf[key] = new_conf[key]
+            self.__generate_connection_guide__()
+            log("Configuration reloaded.")
+
+    def __reload_pool_layout__(self, new_conf: Dict):
+        """Applies a pool_layout change from the next update on. Switching to sharded moves flat packages on that
+        update, so run --migrate-pool first for pools that are already published."""
+        if new_conf.get("pool_layout") == self.conf.get("pool_layout"):
+            return
+        if "pool_layout" in new_conf:
+            self.conf["pool_layout"] = new_conf["pool_layout"]
+        else:
+            self.conf.pop("pool_layout", None)
+        for dist in self.dists.values():
+            dist.sharded_pool = self.sharded_pool
+        log(f"Pool layout changed to {'sharded' if self.sharded_pool else 'flat'}.")
 
-        watcher.start()
+    def __reload_dists__(self, new_conf: Dict):
+        key_id = get_gpg_key_id(self.keyring_dir)
+        updates = []
+        for dist_name in [name for name in self.dists if name not in new_conf["dists"]]:
+            dist = self.dists.pop(dist_name)
+            if self.watcher is not None:
+                self.watcher.remove_directory(dist.pool_dir)
+            dist.unpublish()
+            log(f"{dist_name}: Removed. Its pool is kept in {dist.pool_dir}")
+        for dist_name, dist in self.dists.items():
+            old_pairs = set(dist.index_pairs)
+            added = dist.reconfigure(new_conf["architectures"], new_conf["dists"][dist_name]["components"])
+            if set(dist.index_pairs) != old_pairs:
+                log(f"{dist_name}: Components/architectures changed. Indexing {len(added)} new pool directories.")
+                updates.append((dist, added))
+        for dist_name in [name for name in new_conf["dists"] if name not in self.dists]:
+            dist = self.__create_distribution__(dist_name, new_conf)
+            dist.create_pool_directory()
+            dist.set_key_id(key_id)
+            self.dists[dist_name] = dist
+            if self.watcher is not None:
+                self.watcher.add_directory(dist.pool_dir)
+            log(f"{dist_name}: Added.")
+            updates.append((dist, None))
+        with ThreadPoolExecutor() as executor:
+            futures = {executor.submit(dist.update, pairs): dist for dist, pairs in updates}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as exc:
+                    log(f'{futures[future].name} generated an exception: {exc}', level=ERROR)
 
     def create_service(self, config_path):
         log("Creating systemd service...")
@@ -206,6 +429,7 @@ Description={self.conf['description']}
 [Service]
 WorkingDirectory={self.root_dir}
 ExecStart=debianrepo -c {os.path.realpath(config_path)}
+ExecReload=/bin/kill -HUP $MAINPID
 
 [Install]
 WantedBy=multi-user.target
@@ -216,15 +440,15 @@ WantedBy=multi-user.target
 
         out, err, rc = execute_cmd("systemctl daemon-reload")
         if rc != 0:
-            log(f"Error while reloading systemctl services: {err.decode('utf-8')}")
+            log(f"Error while reloading systemctl services: {err.decode('utf-8')}", level=ERROR)
 
         out, err, rc = execute_cmd(f"systemctl enable {self.conf['short_name']}.service")
         if rc != 0:
-            log(f"Error while enabling {self.conf['short_name']}.service: {err.decode('utf-8')}")
+            log(f"Error while enabling {self.conf['short_name']}.service: {err.decode('utf-8')}", level=ERROR)
 
         out, err, rc = execute_cmd(f"systemctl start {self.conf['short_name']}.service")
         if rc != 0:
-            log(f"Error while starting {self.conf['short_name']}.service: {err.decode('utf-8')}")
+            log(f"Error while starting {self.conf['short_name']}.service: {err.decode('utf-8')}", level=ERROR)
 
         log("Done.")
 
@@ -239,15 +463,15 @@ WantedBy=multi-user.target
 
         out, err, rc = execute_cmd(f"systemctl stop {self.conf['short_name']}.service")
         if rc != 0:
-            log(f"Error while starting {self.conf['short_name']}.service: {err.decode('utf-8')}")
+            log(f"Error while starting {self.conf['short_name']}.service: {err.decode('utf-8')}", level=ERROR)
 
         out, err, rc = execute_cmd(f"systemctl disable {self.conf['short_name']}.service")
         if rc != 0:
-            log(f"Error while enabling {self.conf['short_name']}.service: {err.decode('utf-8')}")
+            log(f"Error while enabling {self.conf['short_name']}.service: {err.decode('utf-8')}", level=ERROR)
 
         out, err, rc = execute_cmd("systemctl daemon-reload")
         if rc != 0:
-            log(f"Error while reloading systemctl services: {err.decode('utf-8')}")
+            log(f"Error while reloading systemctl services: {err.decode('utf-8')}", level=ERROR)
 
         os.remove(service_file_path)
 
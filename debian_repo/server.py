@@ -1,64 +1,182 @@
 import base64
+import hashlib
+import hmac
+import ipaddress
+import json
+import math
+import os
+import tempfile
 from datetime import datetime
 from http.server import SimpleHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
+from urllib.parse import unquote
 
-from .logger import log
+from .logger import log, WARNING
+from .replication import REPLICATION_PATH, TOKEN_HEADER, SHA256_HEADER, CHUNK_SIZE, ManifestBuilder, \
+    ReplicationError, safe_join
+from .throttle import CHUNK_SIZE as THROTTLE_CHUNK_SIZE
 
 unauthorized_access_map = {}
+mirror_manifest_builders = {}
+
+
+class SharedAccessMap:
+    """Worker side of the failed-login map when it lives in the shared state manager. Lookups are answered from
+    the entries this worker wrote or read on a failed login, so successful requests never call the manager. A
+    worker picks up the failures other workers counted for an IP on the next failed login it sees from it."""
+
+    def __init__(self, remote):
+        self.remote = remote
+        self.known = {}
+
+    def get(self, client_ip, default=None):
+        return self.known.get(client_ip, default)
+
+    def setdefault(self, client_ip, default):
+        entry = self.remote.setdefault(client_ip, default)
+        self.known[client_ip] = entry
+        return entry
+
+    def __setitem__(self, client_ip, entry):
+        self.remote[client_ip] = entry
+        self.known[client_ip] = entry
+
+    def pop(self, client_ip, default=None):
+        if self.known.pop(client_ip, None) is None:
+            return default
+        return self.remote.pop(client_ip, default)
+
+
+def parse_trusted_proxies(proxies):
+    """Parses a list of proxy addresses or networks (e.g. "10.0.0.1", "10.0.0.0/8") whose X-Forwarded-For is
+    trusted."""
+    return [ipaddress.ip_network(proxy, strict=False) for proxy in proxies or []]
 
 
 class AuthHandler(SimpleHTTPRequestHandler):
-    def __init__(self, *args, auth="basic", users=None, **kwargs):
+    def __init__(self, *args, auth="basic", users=None, replication_token=None, proxy=None, throttle=None,
+                 trusted_proxies=None, **kwargs):
         self.auth = auth
+        self.trusted_proxies = trusted_proxies or []
         self.users = users
+        self.replication_token = replication_token
+        self.proxy = proxy
+        self.throttle = throttle
+        self.throttle_keys = []
         super().__init__(*args, **kwargs)
 
+    def log_message(self, format, *args):
+        # Access lines go through the async logger instead of a blocking write to stderr.
+        log(f"{self.address_string()} - {format % args}")
+
     def __check_credentials__(self, credentials: str):
         username, password = credentials.split(':')
         return username in self.users and self.users[username] == password
 
     @staticmethod
     def add_to_unauthorized_access_map(client_ip):
-        log(f"Unauthorized access IP: {client_ip}")
-        if client_ip in unauthorized_access_map:
-            unauthorized_access_map[client_ip]["count"] += 1
-        else:
-            unauthorized_access_map[client_ip] = {"count": 1, "first": datetime.now()}
+        log(f"Unauthorized access IP: {client_ip}", level=WARNING)
+        # Entries are written back as a whole so this also works when the map is shared between worker processes.
+        entry = unauthorized_access_map.setdefault(client_ip, {"count": 0, "first": datetime.now()})
+        entry["count"] += 1
+        unauthorized_access_map[client_ip] = entry
 
     @staticmethod
     def check_multiple_unauthorized_access(client_ip):
-        if client_ip in unauthorized_access_map and unauthorized_access_map[client_ip]["count"] >= 5:
-            elapsed_time_from_first = datetime.now() - unauthorized_access_map[client_ip]["first"]
+        entry = unauthorized_access_map.get(client_ip)
+        if entry is not None and entry["count"] >= 5:
+            elapsed_time_from_first = datetime.now() - entry["first"]
             if elapsed_time_from_first.total_seconds() >= (
                     30 * 60):  # Passed 30 mins. Allow 5 failed requests for each 30 mins
-                del unauthorized_access_map[client_ip]
+                unauthorized_access_map.pop(client_ip, None)
                 return False
             return True
         return False
 
     def send_unauthorized_response(self, client_ip):
+        # Counted before responding, so the client's next attempt already sees it.
+        self.add_to_unauthorized_access_map(client_ip)
         self.send_response(401)
         self.send_header('WWW-Authenticate', 'Basic realm=\"Restricted\"')
         self.end_headers()
         self.wfile.write(b'401 Unauthorized - Invalid credentials')
-        self.add_to_unauthorized_access_map(client_ip)
 
     @staticmethod
     def clear_unauthorized_status_for_client(client_ip):
-        if client_ip in unauthorized_access_map:
-            del unauthorized_access_map[client_ip]
+        unauthorized_access_map.pop(client_ip, None)
 
-    def do_GET(self):
-        if not self.auth.lower() == "basic":
+    def __is_trusted_proxy__(self, address: str):
+        try:
+            ip = ipaddress.ip_address(address)
+        except ValueError:
+            return False
+        return any(ip in network for network in self.trusted_proxies)
+
+    def __client_ip__(self):
+        """X-Forwarded-For is only honoured when the connection comes from a trusted proxy. The client is the
+        rightmost address in the chain that isn't a trusted proxy itself, since the leftmost entries are set by
+        the client."""
+        client_ip = self.client_address[0]
+        forwarded_for = self.headers.get('X-Forwarded-For')
+        if not forwarded_for or not self.__is_trusted_proxy__(client_ip):
+            return client_ip
+        for address in reversed([address.strip() for address in forwarded_for.split(',')]):
+            client_ip = address
+            if not self.__is_trusted_proxy__(address):
+                break
+        return client_ip
+
+    def __rate_limited__(self, keys):
+        """Sends 429 and returns True if any of the keys exceeded its request rate."""
+        if self.throttle is None:
+            return False
+        self.throttle_keys = keys
+        retry_after = self.throttle.check_request(keys)
+        if retry_after <= 0:
+            return False
+        self.send_response(429)
+        self.send_header('Retry-After', str(math.ceil(retry_after)))
+        self.end_headers()
+        self.wfile.write(b'429 Too Many Requests - Rate limit exceeded')
+        return True
+
+    def copyfile(self, source, outputfile):
+        if self.throttle is None or not self.throttle.limits_bandwidth:
+            super().copyfile(source, outputfile)
+            return
+        for chunk in iter(lambda: source.read(THROTTLE_CHUNK_SIZE), b""):
+            self.throttle.consume(self.throttle_keys, len(chunk))
+            outputfile.write(chunk)
+
+    def __serve__(self):
+        key = self.proxy.match(self.path) if self.proxy is not None else None
+        if key is None:
             super().do_GET()
             return
 
-        forwarded_for = self.headers.get('X-Forwarded-For')
-        if forwarded_for:
-            client_ip = forwarded_for.split(',')[0].strip()
-        else:
-            client_ip = self.client_address[0]
+        status, length, f = self.proxy.open(key)
+        if f is None:
+            self.send_error(status if status >= 400 else 502)
+            return
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', self.guess_type(key))
+            if length is not None:
+                self.send_header('Content-Length', str(length))
+            else:
+                self.close_connection = True
+            self.end_headers()
+            self.copyfile(f, self.wfile)
+        finally:
+            f.close()
+
+    def do_GET(self):
+        client_ip = self.__client_ip__()
+
+        if not self.auth.lower() == "basic":
+            if not self.__rate_limited__([f"ip:{client_ip}"]):
+                self.__serve__()
+            return
 
         if self.check_multiple_unauthorized_access(client_ip):
             self.send_response(429)
@@ -79,10 +197,104 @@ class AuthHandler(SimpleHTTPRequestHandler):
 
         # Check if the credentials match the expected username and password
         if self.__check_credentials__(credentials):  # Authentication success
-            super().do_GET()
+            if not self.__rate_limited__([f"user:{credentials.split(':')[0]}", f"ip:{client_ip}"]):
+                self.__serve__()
         else:  # Authentication fails
             self.send_unauthorized_response(client_ip)
 
+    def __replication_path__(self):
+        """Returns the relative path of a replication request, or None if the request is not allowed."""
+        token = self.headers.get(TOKEN_HEADER)
+        if not self.replication_token or token is None or \
+                not hmac.compare_digest(token.encode('utf-8'), self.replication_token.encode('utf-8')):
+            return None
+        if not self.path.startswith(REPLICATION_PATH + "/"):
+            return None
+        return unquote(self.path[len(REPLICATION_PATH) + 1:].split('?', 1)[0])
+
+    def __send_text__(self, code: int, body: bytes, content_type="text/plain"):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        rel_path = self.__replication_path__()
+        if rel_path != "manifest":
+            self.send_error(403)
+            return
+        try:
+            prefixes = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        except ValueError:
+            self.__send_text__(400, b'Invalid manifest request')
+            return
+        if not isinstance(prefixes, list) or not all(isinstance(prefix, str) for prefix in prefixes):
+            self.__send_text__(400, b'Invalid manifest request')
+            return
+        if self.directory not in mirror_manifest_builders:
+            mirror_manifest_builders[self.directory] = ManifestBuilder(self.directory)
+        try:
+            manifest = mirror_manifest_builders[self.directory].build(prefixes)
+        except ReplicationError as e:
+            self.__send_text__(400, str(e).encode('utf-8'))
+            return
+        self.__send_text__(200, json.dumps(manifest).encode('utf-8'), "application/json")
+
+    def do_PUT(self):
+        rel_path = self.__replication_path__()
+        if rel_path is None:
+            self.send_error(403)
+            return
+        try:
+            target_path = safe_join(self.directory, rel_path)
+        except ReplicationError as e:
+            self.__send_text__(400, str(e).encode('utf-8'))
+            return
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".replication-", dir=os.path.dirname(target_path))
+        sha256 = hashlib.sha256()
+        remaining = int(self.headers.get('Content-Length', 0))
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                while remaining > 0:
+                    chunk = self.rfile.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        break
+                    sha256.update(chunk)
+                    tmp.write(chunk)
+                    remaining -= len(chunk)
+            if remaining > 0 or sha256.hexdigest() != self.headers.get(SHA256_HEADER):
+                os.remove(tmp_path)
+                self.__send_text__(422, b'Checksum mismatch')
+                return
+            os.replace(tmp_path, target_path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.__send_text__(201, b'Created')
+
+    def do_DELETE(self):
+        rel_path = self.__replication_path__()
+        if rel_path is None:
+            self.send_error(403)
+            return
+        try:
+            target_path = safe_join(self.directory, rel_path)
+        except ReplicationError as e:
+            self.__send_text__(400, str(e).encode('utf-8'))
+            return
+        if os.path.exists(target_path):
+            os.remove(target_path)
+        self.__send_text__(200, b'Deleted')
+
 
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     pass
+
+
+class ReusePortHTTPServer(ThreadedHTTPServer):
+    """Server for pre-forked workers. Each worker binds its own socket to the same port and the kernel spreads
+    incoming connections between them."""
+    allow_reuse_port = True
@@ -0,0 +1,191 @@
+import time
+from collections import OrderedDict
+from threading import Lock
+from typing import List
+
+CHUNK_SIZE = 16 * 1024
+# Workers lease request tokens and bandwidth from the shared Throttle in batches, so the shared state manager sees
+# a few calls per second per client instead of one per request and one per chunk.
+MAX_BANDWIDTH_LEASE = 1024 * 1024
+REQUEST_LEASE_TTL_IN_SEC = 1
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def __refill__(self, now: float):
+        if now > self.last:
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+    def try_take(self, now: float):
+        """Takes one token if available. Returns 0 on success, otherwise the seconds until a token is available."""
+        self.__refill__(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def reserve(self, amount: float, now: float):
+        """Takes amount tokens, going into debt if needed. Returns the seconds the caller must wait before using
+        them. Later callers queue up behind earlier debt, which keeps concurrent consumers fair."""
+        self.__refill__(now)
+        self.tokens -= amount
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class Throttle:
+    """Per-key (user or client IP) request-rate and bandwidth limits. A limit of 0 disables it. Only the most recently
+    seen max_keys keys keep state, older ones start again with a full bucket."""
+
+    def __init__(self, requests_per_sec=0, request_burst=0, bytes_per_sec=0, bandwidth_burst=0, total_bytes_per_sec=0,
+                 max_keys=10000):
+        self.requests_per_sec = requests_per_sec
+        self.request_burst = max(request_burst, requests_per_sec, 1)
+        self.bytes_per_sec = bytes_per_sec
+        self.bandwidth_burst = max(bandwidth_burst, bytes_per_sec, CHUNK_SIZE)
+        self.max_keys = max_keys
+        self.request_buckets: OrderedDict = OrderedDict()
+        self.bandwidth_buckets: OrderedDict = OrderedDict()
+        self.total_bucket = TokenBucket(total_bytes_per_sec, max(total_bytes_per_sec, CHUNK_SIZE)) \
+            if total_bytes_per_sec > 0 else None
+        self.mutex = Lock()
+
+    @property
+    def limits_bandwidth(self):
+        return self.bytes_per_sec > 0 or self.total_bucket is not None
+
+    def __bucket__(self, buckets: OrderedDict, key: str, rate: float, burst: float):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+            buckets[key] = bucket
+            while len(buckets) > self.max_keys:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    @property
+    def request_lease_size(self):
+        """Request tokens a worker takes at once: about a tenth of a second's worth."""
+        return max(1, int(self.requests_per_sec / 10))
+
+    @property
+    def bandwidth_lease_size(self):
+        """Bytes a worker reserves at once: a quarter second at the lowest bandwidth limit, capped at 1 MB."""
+        rates = [rate for rate in (self.bytes_per_sec, self.total_bucket.rate if self.total_bucket else 0) if rate > 0]
+        if not rates:
+            return MAX_BANDWIDTH_LEASE
+        return int(min(MAX_BANDWIDTH_LEASE, max(CHUNK_SIZE, min(rates) / 4)))
+
+    def lease_requests(self, keys: List[str], count: int):
+        """Takes up to count request tokens from every key's bucket. Returns (granted tokens, seconds to wait before
+        retrying if none were granted)."""
+        if self.requests_per_sec <= 0:
+            return count, 0
+        now = time.monotonic()
+        with self.mutex:
+            buckets = [self.__bucket__(self.request_buckets, key, self.requests_per_sec, self.request_burst)
+                       for key in keys]
+            for bucket in buckets:
+                bucket.__refill__(now)
+            available = int(min([bucket.tokens for bucket in buckets], default=count))
+            if available < 1:
+                return 0, max((1 - bucket.tokens) / bucket.rate for bucket in buckets if bucket.tokens < 1)
+            granted = min(count, available)
+            for bucket in buckets:
+                bucket.tokens -= granted
+            return granted, 0
+
+    def check_request(self, keys: List[str]):
+        """Returns 0 if the request is allowed, otherwise the seconds the client should wait before retrying."""
+        if self.requests_per_sec <= 0:
+            return 0
+        now = time.monotonic()
+        with self.mutex:
+            buckets = [self.__bucket__(self.request_buckets, key, self.requests_per_sec, self.request_burst)
+                       for key in keys]
+            waits = [bucket.try_take(now) for bucket in buckets]
+            if max(waits, default=0) > 0:
+                # Refund the keys that did allow it so a request blocked by one limit doesn't count against another.
+                for bucket, wait in zip(buckets, waits):
+                    if wait == 0:
+                        bucket.tokens += 1
+                return max(waits)
+        return 0
+
+    def reserve(self, keys: List[str], amount: int):
+        """Reserves amount bytes for all keys. Returns the seconds the caller must wait before sending them."""
+        now = time.monotonic()
+        with self.mutex:
+            waits = [0]
+            if self.bytes_per_sec > 0:
+                waits += [self.__bucket__(self.bandwidth_buckets, key, self.bytes_per_sec,
+                                          self.bandwidth_burst).reserve(amount, now) for key in keys]
+            if self.total_bucket is not None:
+                waits.append(self.total_bucket.reserve(amount, now))
+        return max(waits)
+
+    def consume(self, keys: List[str], amount: int):
+        """Blocks until amount bytes may be sent for all keys."""
+        wait = self.reserve(keys, amount)
+        if wait > 0:
+            time.sleep(wait)
+
+
+class SharedThrottle:
+    """Worker side of a Throttle that lives in the shared state manager process, so limits hold across all
+    worker processes. Request tokens and bandwidth are leased in batches and spent locally; waiting happens in the
+    worker, the manager only does the bookkeeping."""
+
+    def __init__(self, remote, limits_bandwidth: bool, request_lease_size=1, bandwidth_lease_size=CHUNK_SIZE,
+                 max_keys=10000):
+        self.remote = remote
+        self.limits_bandwidth = limits_bandwidth
+        self.request_lease_size = request_lease_size
+        self.bandwidth_lease_size = bandwidth_lease_size
+        self.max_keys = max_keys
+        self.request_leases: OrderedDict = OrderedDict()
+        self.bandwidth_credits: OrderedDict = OrderedDict()
+        self.mutex = Lock()
+
+    def __store__(self, leases: OrderedDict, key, value):
+        leases[key] = value
+        leases.move_to_end(key)
+        while len(leases) > self.max_keys:
+            leases.popitem(last=False)
+
+    def check_request(self, keys: List[str]):
+        lease_key = tuple(keys)
+        now = time.monotonic()
+        with self.mutex:
+            lease = self.request_leases.get(lease_key)
+            if lease is not None and lease[0] > 0 and lease[1] > now:
+                lease[0] -= 1
+                return 0
+        granted, retry_after = self.remote.lease_requests(keys, self.request_lease_size)
+        if granted < 1:
+            return retry_after
+        with self.mutex:
+            self.__store__(self.request_leases, lease_key, [granted - 1, now + REQUEST_LEASE_TTL_IN_SEC])
+        return 0
+
+    def consume(self, keys: List[str], amount: int):
+        lease_key = tuple(keys)
+        with self.mutex:
+            credit = self.bandwidth_credits.get(lease_key, 0)
+            if credit >= amount:
+                self.__store__(self.bandwidth_credits, lease_key, credit - amount)
+                return
+        reserved = max(amount, self.bandwidth_lease_size)
+        wait = self.remote.reserve(keys, reserved)
+        with self.mutex:
+            self.__store__(self.bandwidth_credits, lease_key,
+                           self.bandwidth_credits.get(lease_key, 0) + reserved - amount)
+        if wait > 0:
+            time.sleep(wait)
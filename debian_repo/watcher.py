@@ -1,8 +1,8 @@
-from .logger import log
+from .logger import log, log_summarized
 
 import pyinotify
 from datetime import datetime
-from threading import Event, Timer
+from threading import Event, Lock, Timer
 from typing import List
 
 last_update = datetime.now()
@@ -13,6 +13,30 @@ class Watcher:
         self.stop_event = stop_event
         self.onupdate = onupdate
         self.directories = directories
+        self.watches = {}
+        self.pending_changes = []
+        self.pending_mutex = Lock()
+
+    def add_directory(self, directory: str):
+        """Starts watching directory. Can be called from any thread, applied by the watcher loop."""
+        with self.pending_mutex:
+            self.pending_changes.append((True, directory))
+
+    def remove_directory(self, directory: str):
+        with self.pending_mutex:
+            self.pending_changes.append((False, directory))
+
+    def __apply_pending_changes__(self, wm):
+        with self.pending_mutex:
+            changes, self.pending_changes = self.pending_changes, []
+        for add, directory in changes:
+            if add and directory not in self.watches:
+                # Add a recursive watch. auto_add also watches subdirectories created later, e.g. new pool shards.
+                self.watches[directory] = wm.add_watch(directory, pyinotify.ALL_EVENTS, rec=True, auto_add=True)
+                log(f"Watching directory: {directory}")
+            elif not add and directory in self.watches:
+                wm.rm_watch(list(self.watches.pop(directory).values()), quiet=True)
+                log(f"Stopped watching directory: {directory}")
     
     def start(self):
         # Watch manager
@@ -22,12 +46,10 @@ class Watcher:
         notifier = pyinotify.Notifier(wm, EventHandler(onupdate=self.onupdate), timeout=1)
         
         for watch_dir in self.directories:
-            # Add a recursive watch
-            wm.add_watch(watch_dir, pyinotify.ALL_EVENTS, rec=True)
-
-            log(f"Watching directory: {watch_dir}")
+            self.add_directory(watch_dir)
             
         while not self.stop_event.is_set():
+            self.__apply_pending_changes__(wm)
             try:
                 notifier.process_events()
                 if notifier.check_events():
@@ -70,26 +92,26 @@ class EventHandler(pyinotify.ProcessEvent):
         pass
 
     def process_IN_CREATE(self, event):
-        log(f"CREATE: {event.pathname}")
+        log_summarized(f"CREATE:{event.path}", f"CREATE: {event.pathname}")
         try_to_update_repo(self.onupdate, event.pathname)
 
     def process_IN_DELETE(self, event):
-        log(f"DELETE: {event.pathname}")
+        log_summarized(f"DELETE:{event.path}", f"DELETE: {event.pathname}")
         try_to_update_repo(self.onupdate, event.pathname)
 
     def process_IN_MODIFY(self, event):
-        log(f"MODIFY: {event.pathname}")
+        log_summarized(f"MODIFY:{event.path}", f"MODIFY: {event.pathname}")
         try_to_update_repo(self.onupdate, event.pathname)
 
     def process_IN_OPEN(self, event):
         pass
 
     def process_IN_MOVED_FROM(self, event):
-        log(f"MOVED_FROM: {event.pathname}")
+        log_summarized(f"MOVED_FROM:{event.path}", f"MOVED_FROM: {event.pathname}")
         try_to_update_repo(self.onupdate, event.pathname)
 
     def process_IN_MOVED_TO(self, event):
-        log(f"MOVED_TO: {event.pathname}")
+        log_summarized(f"MOVED_TO:{event.path}", f"MOVED_TO: {event.pathname}")
         try_to_update_repo(self.onupdate, event.pathname)
 
     def process_default(self, event):
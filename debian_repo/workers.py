@@ -0,0 +1,159 @@
+import multiprocessing
+import os
+import signal
+import time
+from multiprocessing.managers import BaseManager, DictProxy
+from threading import Event, Thread, current_thread, main_thread
+from typing import Dict
+
+from . import server
+from .logger import log, flush_logs, ERROR, WARNING
+from .throttle import SharedThrottle
+
+# Objects served by the shared state manager. The manager process is forked from the master, so it sees the
+# entries set here before it is started.
+shared_state = {}
+
+RESTART_BACKOFF_IN_SEC = 1
+STOP_TIMEOUT_IN_SEC = 30
+
+
+class SharedStateManager(BaseManager):
+    pass
+
+
+SharedStateManager.register("get_unauthorized_access_map", callable=lambda: shared_state["unauthorized_access_map"],
+                            proxytype=DictProxy)
+SharedStateManager.register("get_throttle", callable=lambda: shared_state["throttle"],
+                            exposed=("lease_requests", "reserve"))
+
+
+def ignore_signals():
+    """Initializer of the shared state manager. It inherits the master's handlers, so a SIGHUP sent to the
+    whole service would otherwise run a second configuration reload in it."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+
+class WorkerPool:
+    """Pre-forks serving processes that share the port via SO_REUSEPORT and restarts them when they crash.
+    Exposes serve_forever/shutdown/server_close so it can stand in for the HTTP server in the master."""
+
+    def __init__(self, workers: int, stop_event: Event, create_server, throttle=None, on_reload=None):
+        self.workers = workers
+        self.stop_event = stop_event
+        self.create_server = create_server
+        self.throttle = throttle
+        self.on_reload = on_reload
+        self.pids: Dict[int, int] = {}
+        self.stop_request = Event()
+        self.stopped = Event()
+        self.manager = None
+
+    def __start_manager__(self):
+        shared_state["unauthorized_access_map"] = {}
+        if self.throttle is not None:
+            shared_state["throttle"] = self.throttle
+        self.manager = SharedStateManager(ctx=multiprocessing.get_context("fork"))
+        self.manager.start(initializer=ignore_signals)
+
+    def __spawn__(self, index: int):
+        pid = os.fork()
+        if pid == 0:
+            self.__worker_main__(index)
+        self.pids[pid] = index
+        log(f"Worker {index} started with pid {pid}.")
+
+    def __worker_main__(self, index: int):
+        exit_code = 0
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            # The master's SIGHUP handler is inherited, ignore reloads until the worker's own handler is installed.
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+            manager = SharedStateManager(address=self.manager.address,
+                                         authkey=multiprocessing.current_process().authkey)
+            manager.connect()
+            server.unauthorized_access_map = server.SharedAccessMap(manager.get_unauthorized_access_map())
+            throttle = SharedThrottle(manager.get_throttle(), self.throttle.limits_bandwidth,
+                                      request_lease_size=self.throttle.request_lease_size,
+                                      bandwidth_lease_size=self.throttle.bandwidth_lease_size,
+                                      max_keys=self.throttle.max_keys) if self.throttle is not None else None
+
+            httpd = self.create_server(throttle)
+            # shutdown() blocks until serve_forever returns, so it can't run in the signal handler itself.
+            signal.signal(signal.SIGTERM, lambda *args: Thread(target=httpd.shutdown).start())
+            if self.on_reload is not None:
+                signal.signal(signal.SIGHUP, lambda *args: Thread(target=self.on_reload).start())
+            httpd.serve_forever()
+            httpd.server_close()  # Waits for in-flight requests.
+        except Exception as e:
+            log(f"Worker {index} failed: {e}", level=ERROR)
+            exit_code = 1
+        finally:
+            flush_logs()
+            os._exit(exit_code)
+
+    def __reap__(self):
+        # Only wait for our own pids, the shared state manager is a child process too.
+        for pid in list(self.pids):
+            waited_pid, status = os.waitpid(pid, os.WNOHANG)
+            if waited_pid == 0:
+                continue
+            index = self.pids.pop(pid)
+            if not self.stop_request.is_set():
+                log(f"Worker {index} (pid {pid}) exited with status {os.waitstatus_to_exitcode(status)}. "
+                    f"Restarting...", level=WARNING)
+                time.sleep(RESTART_BACKOFF_IN_SEC)
+                self.__spawn__(index)
+
+    def __stop_workers__(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + STOP_TIMEOUT_IN_SEC
+        while self.pids and time.monotonic() < deadline:
+            for pid in list(self.pids):
+                if os.waitpid(pid, os.WNOHANG)[0] != 0:
+                    self.pids.pop(pid)
+            time.sleep(0.1)
+        for pid in self.pids:
+            log(f"Worker pid {pid} didn't stop in {STOP_TIMEOUT_IN_SEC}s. Killing.", level=WARNING)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self.pids.clear()
+
+    def reload(self):
+        """Asks every worker to re-read its HTTP settings."""
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signal.SIGHUP)
+            except ProcessLookupError:
+                pass
+
+    def serve_forever(self):
+        previous_sigterm_handler = None
+        if current_thread() is main_thread():
+            previous_sigterm_handler = signal.signal(signal.SIGTERM, lambda *args: self.stop_request.set())
+        try:
+            self.__start_manager__()
+            for index in range(self.workers):
+                self.__spawn__(index)
+            while not self.stop_request.wait(0.5) and not self.stop_event.is_set():
+                self.__reap__()
+        finally:
+            self.stop_request.set()
+            self.__stop_workers__()
+            if previous_sigterm_handler is not None:
+                signal.signal(signal.SIGTERM, previous_sigterm_handler)
+            self.stopped.set()
+
+    def shutdown(self):
+        self.stop_request.set()
+        self.stopped.wait()
+
+    def server_close(self):
+        if self.manager is not None:
+            self.manager.shutdown()
+            self.manager = None
@@ -1,13 +1,35 @@
 from datetime import datetime, timedelta
 import unittest
 import os
+import fcntl
 import shutil
 import tarfile
+import io
+import json
+import signal
+import socket
+import time
+from contextlib import redirect_stdout
+from functools import partial
+from unittest.mock import patch
+from http.server import SimpleHTTPRequestHandler
+from threading import Event, Thread
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
 from zipfile import ZipFile
 
 from debian_repo.common import execute_cmd
-from debian_repo.server import AuthHandler, unauthorized_access_map
+from debian_repo.distribution import Distribution
+from debian_repo.helpers import get_deb_source_name, get_pool_shard
+from debian_repo.server import AuthHandler, ThreadedHTTPServer, ReusePortHTTPServer, unauthorized_access_map, \
+    parse_trusted_proxies, SharedAccessMap
 from debian_repo.backup import BackupManager
+from debian_repo.logger import AsyncLogger, DEBUG, ERROR
+from debian_repo.proxy import ProxyCache, is_immutable
+from debian_repo.repository import DebianRepository
+from debian_repo.replication import Replicator, DirectoryTarget, HttpTarget, ReplicationError, transfer_order
+from debian_repo.throttle import Throttle, TokenBucket, SharedThrottle
+from debian_repo.workers import WorkerPool
 
 
 class TestOps(unittest.TestCase):
@@ -111,6 +133,689 @@ class TestAuthorization(unittest.TestCase):
         result = AuthHandler.check_multiple_unauthorized_access(client_ip)
         self.assertFalse(result, "Should return True for IP exceeding threshold exactly at 30 minutes")
 
+    def test_shared_map_only_used_on_failures(self):
+        class CountingDict(dict):
+            calls = 0
+
+            def setdefault(self, key, default=None):
+                CountingDict.calls += 1
+                return dict(super().setdefault(key, default))
+
+            def __setitem__(self, key, value):
+                CountingDict.calls += 1
+                super().__setitem__(key, dict(value))
+
+            def pop(self, key, default=None):
+                CountingDict.calls += 1
+                return super().pop(key, default)
+
+        remote = CountingDict()
+        client_ip = "192.168.1.6"
+        with patch("debian_repo.server.unauthorized_access_map", SharedAccessMap(remote)):
+            for _ in range(10):
+                self.assertFalse(AuthHandler.check_multiple_unauthorized_access(client_ip))
+                AuthHandler.clear_unauthorized_status_for_client(client_ip)
+            self.assertEqual(CountingDict.calls, 0)
+
+            for _ in range(5):
+                AuthHandler.add_to_unauthorized_access_map(client_ip)
+            self.assertEqual(remote[client_ip]["count"], 5)
+            self.assertTrue(AuthHandler.check_multiple_unauthorized_access(client_ip))
+            AuthHandler.clear_unauthorized_status_for_client(client_ip)
+            self.assertNotIn(client_ip, remote)
+
+
+class TestReplication(unittest.TestCase):
+    def setUp(self):
+        self.primary_dir = "test_replication_primary"
+        self.mirror_dir = "test_replication_mirror"
+        self.dist = os.path.join("debian", "dists", "jammy")
+        for rel_path, content in [("publickey.gpg", "key"),
+                                  (os.path.join(self.dist, "pool", "stable", "amd64", "a.deb"), "a"),
+                                  (os.path.join(self.dist, "stable", "binary-amd64", "Packages"), "Package: a"),
+                                  (os.path.join(self.dist, "Release"), "Release")]:
+            self.write(self.primary_dir, rel_path, content)
+        os.makedirs(self.mirror_dir, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.primary_dir)
+        shutil.rmtree(self.mirror_dir)
+
+    @staticmethod
+    def write(root, rel_path, content):
+        os.makedirs(os.path.dirname(os.path.join(root, rel_path)), exist_ok=True)
+        with open(os.path.join(root, rel_path), "w") as f:
+            f.write(content)
+
+    def read_mirror(self, rel_path):
+        with open(os.path.join(self.mirror_dir, rel_path)) as f:
+            return f.read()
+
+    def test_transfer_order(self):
+        paths = [os.path.join(self.dist, "Release"), os.path.join(self.dist, "stable", "binary-amd64", "Packages"),
+                 os.path.join(self.dist, "pool", "stable", "amd64", "a.deb")]
+        self.assertEqual(sorted(paths, key=transfer_order), list(reversed(paths)))
+
+    def test_push_to_directory(self):
+        target = DirectoryTarget(self.mirror_dir)
+        replicator = Replicator(self.primary_dir, [target])
+        replicator.push(["publickey.gpg", self.dist])
+        self.assertTrue(replicator.wait_idle(10))
+        self.assertEqual(self.read_mirror(os.path.join(self.dist, "pool", "stable", "amd64", "a.deb")), "a")
+
+        os.remove(os.path.join(self.primary_dir, self.dist, "pool", "stable", "amd64", "a.deb"))
+        self.write(self.primary_dir, os.path.join(self.dist, "pool", "stable", "amd64", "b.deb"), "b")
+        self.write(self.primary_dir, os.path.join(self.dist, "Release"), "Release 2")
+        replicator.push(["publickey.gpg", self.dist])
+        self.assertTrue(replicator.wait_idle(10))
+        self.assertFalse(os.path.exists(os.path.join(self.mirror_dir, self.dist, "pool", "stable", "amd64", "a.deb")))
+        self.assertEqual(self.read_mirror(os.path.join(self.dist, "Release")), "Release 2")
+        self.assertEqual(target.fetch_manifest(["publickey.gpg", self.dist]),
+                         replicator.manifest_builder.build(["publickey.gpg", self.dist]))
+
+    def test_push_over_http(self):
+        handler = partial(AuthHandler, auth="none", users={}, replication_token="secret",
+                          directory=os.path.realpath(self.mirror_dir))
+        httpd = ThreadedHTTPServer(("127.0.0.1", 0), handler)
+        Thread(target=httpd.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{httpd.server_address[1]}"
+        try:
+            replicator = Replicator(self.primary_dir, [HttpTarget(url, "secret")])
+            replicator.push(["publickey.gpg", self.dist])
+            self.assertTrue(replicator.wait_idle(10))
+            with urlopen(f"{url}/{self.dist}/stable/binary-amd64/Packages") as response:
+                self.assertEqual(response.read(), b"Package: a")
+            with self.assertRaises(ReplicationError):
+                HttpTarget(url, "wrong").delete(os.path.join(self.dist, "Release"))
+            with self.assertRaises(ReplicationError):
+                HttpTarget(url, "secret").delete("../outside")
+            request = Request(f"{url}/.replication/manifest", data=b"not json", method="POST",
+                              headers={"X-Replication-Token": "secret"})
+            with self.assertRaises(HTTPError) as context:
+                urlopen(request)
+            self.assertEqual(context.exception.code, 400)
+            self.assertTrue(os.path.exists(os.path.join(self.mirror_dir, self.dist, "Release")))
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_dead_secondary_does_not_block_push(self):
+        replicator = Replicator(self.primary_dir, [HttpTarget("http://127.0.0.1:9", "secret", timeout=1),
+                                                   DirectoryTarget(self.mirror_dir)])
+        start = time.monotonic()
+        replicator.push(["publickey.gpg", self.dist])
+        self.assertLess(time.monotonic() - start, 0.5)
+        self.assertTrue(replicator.workers[1].wait_idle(10))
+        self.assertEqual(self.read_mirror("publickey.gpg"), "key")
+
+
+class CountingUpstreamHandler(SimpleHTTPRequestHandler):
+    requests = []
+
+    def do_GET(self):
+        CountingUpstreamHandler.requests.append(self.path)
+        time.sleep(0.2)
+        super().do_GET()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestProxy(unittest.TestCase):
+    def setUp(self):
+        self.upstream_dir = "test_proxy_upstream"
+        self.cache_dir = "test_proxy_cache"
+        os.makedirs(os.path.join(self.upstream_dir, "pool", "main"), exist_ok=True)
+        os.makedirs(os.path.join(self.upstream_dir, "dists", "jammy"), exist_ok=True)
+        with open(os.path.join(self.upstream_dir, "pool", "main", "a.deb"), "wb") as f:
+            f.write(b"a" * 300 * 1024)
+        with open(os.path.join(self.upstream_dir, "dists", "jammy", "Release"), "w") as f:
+            f.write("Release")
+        CountingUpstreamHandler.requests = []
+        handler = partial(CountingUpstreamHandler, directory=os.path.realpath(self.upstream_dir))
+        self.upstream = ThreadedHTTPServer(("127.0.0.1", 0), handler)
+        Thread(target=self.upstream.serve_forever, daemon=True).start()
+        self.upstream_url = f"http://127.0.0.1:{self.upstream.server_address[1]}"
+
+    def tearDown(self):
+        self.upstream.shutdown()
+        self.upstream.server_close()
+        shutil.rmtree(self.upstream_dir)
+        shutil.rmtree(self.cache_dir)
+
+    @staticmethod
+    def read(proxy, key):
+        status, length, f = proxy.open(key)
+        if f is None:
+            return status, None
+        try:
+            return status, b"".join(iter(lambda: f.read(64 * 1024), b""))
+        finally:
+            f.close()
+            while proxy.in_flight:
+                time.sleep(0.01)
+
+    def test_match(self):
+        proxy = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url})
+        self.assertEqual(proxy.match("/ubuntu/pool/main/a.deb?x=1"), "ubuntu/pool/main/a.deb")
+        self.assertIsNone(proxy.match("/debian/dists/jammy/Release"))
+        self.assertIsNone(proxy.match("/ubuntu/../keyring/x"))
+        self.assertTrue(is_immutable("ubuntu/pool/main/a.deb"))
+        self.assertFalse(is_immutable("ubuntu/dists/jammy/Release"))
+
+    def test_concurrent_misses_collapse(self):
+        proxy = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url})
+        results = []
+        threads = [Thread(target=lambda: results.append(self.read(proxy, "ubuntu/pool/main/a.deb")))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [(200, b"a" * 300 * 1024)] * 5)
+        self.assertEqual(len(CountingUpstreamHandler.requests), 1)
+        self.assertEqual(self.read(proxy, "ubuntu/pool/main/a.deb")[0], 200)
+        self.assertEqual(len(CountingUpstreamHandler.requests), 1)
+        self.assertEqual(self.read(proxy, "ubuntu/pool/main/missing.deb")[0], 404)
+
+    def test_index_revalidation(self):
+        proxy = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url}, index_ttl_in_sec=0)
+        self.assertEqual(self.read(proxy, "ubuntu/dists/jammy/Release"), (200, b"Release"))
+        self.assertEqual(self.read(proxy, "ubuntu/dists/jammy/Release"), (200, b"Release"))
+        self.assertEqual(len(CountingUpstreamHandler.requests), 2)
+
+    def test_lru_eviction(self):
+        with open(os.path.join(self.upstream_dir, "pool", "main", "b.deb"), "wb") as f:
+            f.write(b"b" * 900 * 1024)
+        proxy = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url}, max_size_in_mb=1)
+        self.read(proxy, "ubuntu/pool/main/a.deb")
+        self.read(proxy, "ubuntu/pool/main/b.deb")
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "ubuntu", "pool", "main", "a.deb")))
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, "ubuntu", "pool", "main", "b.deb")))
+        self.assertLessEqual(proxy.total_size, 1024 * 1024)
+
+    def test_failed_caching_ends_fetch(self):
+        proxy = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url})
+        add_to_shared_size = proxy.__add_to_shared_size__
+
+        def fail(delta):
+            proxy.__add_to_shared_size__ = add_to_shared_size
+            raise OSError("disk full")
+
+        proxy.__add_to_shared_size__ = fail
+        self.assertEqual(self.read(proxy, "ubuntu/pool/main/a.deb"), (200, b"a" * 300 * 1024))
+        self.assertEqual(proxy.in_flight, {})
+        self.assertEqual(self.read(proxy, "ubuntu/pool/main/a.deb"), (200, b"a" * 300 * 1024))
+        self.assertEqual([f for f in os.listdir(os.path.join(self.cache_dir, "ubuntu", "pool", "main"))
+                          if f.startswith(".proxy-")], [])
+
+    def test_partial_files_removed_on_load(self):
+        partial_path = os.path.join(self.cache_dir, "ubuntu", "pool", "main", ".proxy-abc")
+        os.makedirs(os.path.dirname(partial_path))
+        with open(partial_path, "w") as f:
+            f.write("partial")
+        proxy = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url})
+        self.assertTrue(os.path.exists(partial_path))
+        proxy.load()
+        self.assertFalse(os.path.exists(partial_path))
+
+    def test_eviction_skips_in_flight(self):
+        proxy = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url}, max_size_in_mb=1)
+        proxy.lru.update([("ubuntu/pool/main/a.deb", 900 * 1024), ("ubuntu/dists/jammy/Release", 900 * 1024)])
+        proxy.total_size = 1800 * 1024
+        proxy.in_flight.update({key: None for key in proxy.lru})
+        evict_thread = Thread(target=proxy.__evict__, args=(proxy.max_size,), daemon=True)
+        evict_thread.start()
+        evict_thread.join(5)
+        self.assertFalse(evict_thread.is_alive())
+        self.assertEqual(list(proxy.lru), ["ubuntu/pool/main/a.deb", "ubuntu/dists/jammy/Release"])
+
+    def test_eviction_shared_between_workers(self):
+        with open(os.path.join(self.upstream_dir, "pool", "main", "b.deb"), "wb") as f:
+            f.write(b"b" * 900 * 1024)
+        first = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url}, max_size_in_mb=1)
+        second = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url}, max_size_in_mb=1)
+        self.read(first, "ubuntu/pool/main/a.deb")
+        self.read(second, "ubuntu/pool/main/b.deb")
+        self.assertFalse(os.path.exists(os.path.join(self.cache_dir, "ubuntu", "pool", "main", "a.deb")))
+        self.assertLessEqual(second.total_size, 1024 * 1024)
+
+    def test_eviction_frees_to_low_watermark(self):
+        for i in range(14):
+            with open(os.path.join(self.upstream_dir, "pool", "main", f"{i}.deb"), "wb") as f:
+                f.write(b"x" * 100 * 1024)
+        proxy = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url}, max_size_in_mb=1)
+        scans = []
+        scan = proxy.__scan__
+        proxy.__scan__ = lambda: scans.append(1) or scan()
+        for i in range(14):
+            self.read(proxy, f"ubuntu/pool/main/{i}.deb")
+        # Evicting only down to the limit would rescan on every fetch from the 11th on.
+        self.assertEqual(len(scans), 2)
+        self.assertEqual(proxy.total_size, 1000 * 1024)
+        self.assertNotIn("ubuntu/pool/main/0.deb", proxy.lru)
+
+    def test_refetch_when_evicted_before_open(self):
+        proxy = ProxyCache(self.cache_dir, {"ubuntu": self.upstream_url})
+        self.read(proxy, "ubuntu/pool/main/a.deb")
+        cached_path = os.path.join(self.cache_dir, "ubuntu", "pool", "main", "a.deb")
+        touch = proxy.__touch__
+
+        def evict_then_touch(key):
+            if os.path.exists(cached_path):
+                os.remove(cached_path)
+            touch(key)
+
+        proxy.__touch__ = evict_then_touch
+        self.assertEqual(self.read(proxy, "ubuntu/pool/main/a.deb"), (200, b"a" * 300 * 1024))
+        self.assertEqual(len(CountingUpstreamHandler.requests), 2)
+
+
+class TestThrottle(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        now = bucket.last
+        self.assertEqual(bucket.try_take(now), 0)
+        self.assertEqual(bucket.try_take(now), 0)
+        self.assertAlmostEqual(bucket.try_take(now), 1)
+        self.assertEqual(bucket.try_take(now + 1), 0)
+
+    def test_reserve_queues_consumers(self):
+        bucket = TokenBucket(rate=100, burst=100)
+        now = bucket.last
+        self.assertEqual(bucket.reserve(100, now), 0)
+        self.assertAlmostEqual(bucket.reserve(100, now), 1)
+        self.assertAlmostEqual(bucket.reserve(100, now), 2)
+
+    def test_request_limit_per_key(self):
+        throttle = Throttle(requests_per_sec=1, request_burst=2)
+        self.assertEqual(throttle.check_request(["user:a", "ip:1"]), 0)
+        self.assertEqual(throttle.check_request(["user:a", "ip:1"]), 0)
+        self.assertGreater(throttle.check_request(["user:a", "ip:1"]), 0)
+        self.assertEqual(throttle.check_request(["user:b", "ip:2"]), 0)
+
+    def test_bounded_state(self):
+        throttle = Throttle(requests_per_sec=1, max_keys=3)
+        for i in range(10):
+            throttle.check_request([f"ip:{i}"])
+        self.assertEqual(list(throttle.request_buckets), ["ip:7", "ip:8", "ip:9"])
+
+    def test_http_rate_limit(self):
+        handler = partial(AuthHandler, auth="none", users={}, throttle=Throttle(requests_per_sec=0.5, request_burst=1),
+                          directory=os.path.realpath("."))
+        httpd = ThreadedHTTPServer(("127.0.0.1", 0), handler)
+        Thread(target=httpd.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{httpd.server_address[1]}/tests.py"
+        try:
+            with urlopen(url) as response:
+                self.assertEqual(response.status, 200)
+            with self.assertRaises(HTTPError) as context:
+                urlopen(url)
+            self.assertEqual(context.exception.code, 429)
+            self.assertEqual(context.exception.headers.get("Retry-After"), "2")
+        finally:
+            httpd.shutdown()
+            httpd.server_close()
+
+    def test_shared_throttle_leases_in_batches(self):
+        class CountingRemote:
+            def __init__(self, throttle):
+                self.throttle = throttle
+                self.calls = 0
+
+            def lease_requests(self, keys, count):
+                self.calls += 1
+                return self.throttle.lease_requests(keys, count)
+
+            def reserve(self, keys, amount):
+                self.calls += 1
+                return self.throttle.reserve(keys, amount)
+
+        throttle = Throttle(requests_per_sec=100, request_burst=100, bytes_per_sec=16 * 1024 * 1024)
+        remote = CountingRemote(throttle)
+        shared = SharedThrottle(remote, throttle.limits_bandwidth, request_lease_size=throttle.request_lease_size,
+                                bandwidth_lease_size=throttle.bandwidth_lease_size)
+        for _ in range(100):
+            self.assertEqual(shared.check_request(["ip:1"]), 0)
+        self.assertEqual(remote.calls, 10)
+        self.assertGreater(shared.check_request(["ip:1"]), 0)
+
+        remote.calls = 0
+        for _ in range(64):
+            shared.consume(["ip:1"], 16 * 1024)
+        self.assertEqual(remote.calls, 1)
+
+    @staticmethod
+    def client_ip(peer, forwarded_for, trusted_proxies):
+        handler = AuthHandler.__new__(AuthHandler)
+        handler.client_address = (peer, 12345)
+        handler.headers = {"X-Forwarded-For": forwarded_for} if forwarded_for else {}
+        handler.trusted_proxies = parse_trusted_proxies(trusted_proxies)
+        return handler.__client_ip__()
+
+    def test_forwarded_for_needs_trusted_proxy(self):
+        self.assertEqual(self.client_ip("1.2.3.4", "5.6.7.8", []), "1.2.3.4")
+        self.assertEqual(self.client_ip("1.2.3.4", "5.6.7.8", ["10.0.0.0/8"]), "1.2.3.4")
+        self.assertEqual(self.client_ip("10.0.0.1", "5.6.7.8", ["10.0.0.0/8"]), "5.6.7.8")
+        self.assertEqual(self.client_ip("10.0.0.1", "9.9.9.9, 5.6.7.8, 10.0.0.2", ["10.0.0.0/8"]), "5.6.7.8")
+        self.assertEqual(self.client_ip("10.0.0.1", None, ["10.0.0.0/8"]), "10.0.0.1")
+
+    def test_bandwidth_limit(self):
+        throttle = Throttle(bytes_per_sec=64 * 1024, bandwidth_burst=64 * 1024)
+        start = time.monotonic()
+        for _ in range(12):
+            throttle.consume(["ip:1"], 16 * 1024)
+        self.assertGreaterEqual(time.monotonic() - start, 0.4)
+
+
+class TestLogger(unittest.TestCase):
+    def capture(self, logger, fn):
+        out = io.StringIO()
+        with redirect_stdout(out):
+            fn()
+            logger.flush()
+        return out.getvalue().splitlines()
+
+    def test_levels(self):
+        logger = AsyncLogger(level=ERROR)
+
+        def write():
+            logger.log("info message")
+            logger.log("error message", level=ERROR)
+        self.assertEqual(self.capture(logger, write), ["ERROR: error message"])
+
+        logger.configure(level="debug")
+        self.assertEqual(logger.level, DEBUG)
+
+    def test_json_format(self):
+        logger = AsyncLogger(json_format=True)
+        lines = self.capture(logger, lambda: logger.log("hello"))
+        record = json.loads(lines[0])
+        self.assertEqual(record["message"], "hello")
+        self.assertEqual(record["level"], "info")
+
+    def test_summarized(self):
+        logger = AsyncLogger(summary_interval=60)
+
+        def write():
+            for i in range(100):
+                logger.log_summarized("MODIFY:/pool", f"MODIFY: /pool/{i}.deb")
+        self.assertEqual(self.capture(logger, write),
+                         ["MODIFY: /pool/0.deb", "MODIFY: /pool/99.deb (and 99 similar in the last 60s)"])
+
+    def test_full_queue_drops(self):
+        logger = AsyncLogger(max_queue=1)
+        logger.writer = Thread()  # Keep the queue from being drained.
+        logger.log("first")
+        logger.log("second")
+        self.assertEqual(logger.dropped, 1)
+        self.assertEqual(logger.queue.qsize(), 1)
+
+
+class TestWorkers(unittest.TestCase):
+    def test_prefork_workers(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+
+        def create_server(throttle):
+            handler = partial(AuthHandler, auth="basic", users={"user": "password"}, throttle=throttle,
+                              directory=os.path.realpath("."))
+            return ReusePortHTTPServer(("127.0.0.1", port), handler)
+
+        stop_event = Event()
+        pool = WorkerPool(2, stop_event, create_server, throttle=Throttle(requests_per_sec=1000))
+        Thread(target=pool.serve_forever, daemon=True).start()
+        try:
+            url = f"http://127.0.0.1:{port}/tests.py"
+            for _ in range(50):
+                try:
+                    socket.create_connection(("127.0.0.1", port)).close()
+                    break
+                except OSError:
+                    time.sleep(0.1)
+            # Failed logins are counted in the shared map no matter which worker served them. The worker that
+            # didn't serve the 5th failure may let one more attempt through, which gives it the shared count.
+            codes = []
+            for _ in range(5 + 5):
+                with self.assertRaises(HTTPError) as context:
+                    urlopen(url)
+                codes.append(context.exception.code)
+            self.assertEqual(codes[:5], [401] * 5)
+            self.assertLessEqual(codes[5:].count(401), 1)
+            self.assertGreaterEqual(codes[5:].count(429), 4)
+
+            crashed_pid = next(iter(pool.pids))
+            os.kill(crashed_pid, signal.SIGKILL)
+            for _ in range(50):
+                if crashed_pid not in pool.pids and len(pool.pids) == 2:
+                    break
+                time.sleep(0.1)
+            self.assertNotIn(crashed_pid, pool.pids)
+            self.assertEqual(len(pool.pids), 2)
+        finally:
+            stop_event.set()
+            pool.shutdown()
+            pool.server_close()
+        self.assertEqual(pool.pids, {})
+
+
+    def test_manager_ignores_sighup(self):
+        marker_path = os.path.realpath("test_manager_sighup")
+        previous_handler = signal.signal(signal.SIGHUP, lambda *args: open(marker_path, "w").close())
+        pool = WorkerPool(2, Event(), None)
+        try:
+            pool.__start_manager__()
+            os.kill(pool.manager._process.pid, signal.SIGHUP)
+            time.sleep(0.5)
+            self.assertTrue(pool.manager._process.is_alive())
+            self.assertFalse(os.path.exists(marker_path))
+        finally:
+            signal.signal(signal.SIGHUP, previous_handler)
+            pool.server_close()
+            if os.path.exists(marker_path):
+                os.remove(marker_path)
+
+
+class TestConfigReload(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = os.path.realpath("test_reload")
+        self.config_path = os.path.join(self.root_dir, "config.json")
+        self.conf = {"architectures": ["amd64"],
+                     "dists": {"focal": {"components": ["stable"]}, "jammy": {"components": ["stable"]}},
+                     "short_name": "test_repo", "description": "Test repository", "email": "test@test.com",
+                     "name": "Test User", "http_server": {"port": 8645, "auth": "basic", "users": {"a": "a"}}}
+        os.makedirs(self.root_dir, exist_ok=True)
+        self.write_config()
+        self.repository = DebianRepository(config=json.loads(json.dumps(self.conf)),
+                                           repo_dir=os.path.join(self.root_dir, "repo"), config_path=self.config_path)
+        self.repository.create_pool_directories()
+        self.repository.update_all_dists()
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def write_config(self):
+        with open(self.config_path, "w") as f:
+            json.dump(self.conf, f)
+
+    def test_reload(self):
+        dists_dir = self.repository.dists_dir
+        jammy_packages = os.path.join(dists_dir, "jammy", "stable", "binary-amd64", "Packages")
+        jammy_packages_mtime = os.path.getmtime(jammy_packages)
+
+        self.conf["http_server"]["users"]["b"] = "b"
+        self.conf["http_server"]["port"] = 9000
+        self.conf["http_server"]["trusted_proxies"] = ["10.0.0.0/8"]
+        del self.conf["dists"]["focal"]
+        self.conf["dists"]["jammy"]["components"].append("updates")
+        self.conf["dists"]["noble"] = {"components": ["stable"]}
+        self.write_config()
+        self.repository.reload_config()
+
+        self.assertEqual(self.repository.conf["http_server"]["users"], {"a": "a", "b": "b"})
+        self.assertEqual(self.repository.port, 8645)
+        self.assertEqual(self.repository.trusted_proxies, parse_trusted_proxies(["10.0.0.0/8"]))
+        self.assertEqual(sorted(self.repository.dists), ["jammy", "noble"])
+        self.assertFalse(os.path.exists(os.path.join(dists_dir, "focal", "Release")))
+        self.assertTrue(os.path.isdir(os.path.join(dists_dir, "focal", "pool", "stable", "amd64")))
+        self.assertTrue(os.path.exists(os.path.join(dists_dir, "jammy", "updates", "binary-amd64", "Packages")))
+        self.assertEqual(os.path.getmtime(jammy_packages), jammy_packages_mtime)
+        self.assertTrue(os.path.exists(os.path.join(dists_dir, "noble", "stable", "binary-amd64", "Packages")))
+        with open(os.path.join(dists_dir, "jammy", "Release")) as f:
+            self.assertIn("Components: stable updates", f.read())
+
+    def test_reload_pool_layout(self):
+        self.conf["pool_layout"] = "sharded"
+        self.write_config()
+        self.repository.reload_config()
+        self.assertTrue(all(dist.sharded_pool for dist in self.repository.dists.values()))
+
+    def test_reload_after_chdir(self):
+        mirror_dir = os.path.join(self.root_dir, "mirror")
+        self.conf["replication"] = {"secondaries": [mirror_dir]}
+        self.write_config()
+        cwd = os.getcwd()
+        repository = DebianRepository(config=json.loads(json.dumps(self.conf)),
+                                      repo_dir=os.path.join(self.root_dir, "repo"),
+                                      config_path=os.path.relpath(self.config_path))
+        repository.update_all_dists()
+        self.assertTrue(repository.replicator.wait_idle(10))
+        focal_release = os.path.join("debian", "dists", "focal", "Release")
+        self.assertTrue(os.path.exists(os.path.join(mirror_dir, focal_release)))
+
+        del self.conf["dists"]["focal"]
+        self.write_config()
+        os.chdir(repository.dir)
+        try:
+            repository.reload_config()
+        finally:
+            os.chdir(cwd)
+        self.assertEqual(sorted(repository.dists), ["jammy"])
+        self.assertTrue(repository.replicator.wait_idle(10))
+        self.assertFalse(os.path.exists(os.path.join(mirror_dir, focal_release)))
+
+
+def build_deb(out_dir, package, version="1.0", arch="amd64", source=None):
+    build_dir = os.path.join(out_dir, f"{package}_build")
+    os.makedirs(os.path.join(build_dir, "DEBIAN"), exist_ok=True)
+    with open(os.path.join(build_dir, "DEBIAN", "control"), "w") as f:
+        f.write(f"Package: {package}\nVersion: {version}\nArchitecture: {arch}\nMaintainer: Test <test@test.com>\n"
+                f"Description: Test package\n" + (f"Source: {source}\n" if source else ""))
+    deb_path = os.path.join(out_dir, f"{package}_{version}_{arch}.deb")
+    out, err, rc = execute_cmd(f"dpkg-deb --build {build_dir} {deb_path}")
+    shutil.rmtree(build_dir)
+    if rc != 0:
+        raise Exception(err.decode("utf-8"))
+    return deb_path
+
+
+class TestShardedPool(unittest.TestCase):
+    def setUp(self):
+        self.debian_dir = os.path.realpath("test_sharded_pool")
+        self.dist = Distribution("jammy", os.path.join(self.debian_dir, "dists", "jammy"), ["amd64"], ["stable"],
+                                 os.path.join(self.debian_dir, "keyring"), self.debian_dir, "Test repository")
+        self.dist.set_key_id("")
+        self.pool_path = os.path.join(self.dist.pool_dir, "stable", "amd64")
+        os.makedirs(self.pool_path, exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.debian_dir)
+
+    def read_packages(self):
+        with open(os.path.join(self.dist.dist_dir, "stable", "binary-amd64", "Packages")) as f:
+            return f.read()
+
+    def test_pool_shard(self):
+        self.assertEqual(get_pool_shard("libssl3"), os.path.join("libs", "libssl3"))
+        self.assertEqual(get_pool_shard("curl"), os.path.join("c", "curl"))
+        self.assertEqual(get_deb_source_name(build_deb(self.pool_path, "libfoo1", source="libfoo (1.0-1)")), "libfoo")
+        quoted_path = os.path.join(self.pool_path, "it's; touch injected.deb")
+        shutil.move(build_deb(self.pool_path, "bar"), quoted_path)
+        self.assertEqual(get_deb_source_name(quoted_path), "bar")
+        self.assertFalse(os.path.exists("injected.deb"))
+
+    def test_migrate_pool(self):
+        build_deb(self.pool_path, "libfoo1", source="libfoo")
+        build_deb(self.pool_path, "bar")
+        self.dist.update()
+        self.assertIn("Filename: dists/jammy/pool/stable/amd64/bar_1.0_amd64.deb", self.read_packages())
+
+        self.dist.sharded_pool = True
+        self.dist.migrate_pool(grace_period_in_sec=0)
+        packages = self.read_packages()
+        self.assertIn("Filename: dists/jammy/pool/stable/amd64/b/bar/bar_1.0_amd64.deb", packages)
+        self.assertIn("Filename: dists/jammy/pool/stable/amd64/libf/libfoo/libfoo1_1.0_amd64.deb", packages)
+        self.assertEqual(packages.count("Package: "), 2)
+        self.assertFalse(os.path.exists(os.path.join(self.pool_path, "bar_1.0_amd64.deb")))
+
+    def test_linked_flat_copy_not_indexed(self):
+        flat_path = build_deb(self.pool_path, "bar")
+        os.makedirs(os.path.join(self.pool_path, "b", "bar"))
+        os.link(flat_path, os.path.join(self.pool_path, "b", "bar", "bar_1.0_amd64.deb"))
+        self.dist.update()
+        packages = self.read_packages()
+        self.assertIn("Filename: dists/jammy/pool/stable/amd64/b/bar/bar_1.0_amd64.deb", packages)
+        self.assertEqual(packages.count("Package: "), 1)
+        self.assertTrue(os.path.exists(flat_path))
+
+    def test_new_packages_are_sharded(self):
+        self.dist.sharded_pool = True
+        build_deb(self.pool_path, "baz")
+        self.dist.update()
+        self.assertTrue(os.path.exists(os.path.join(self.pool_path, "b", "baz", "baz_1.0_amd64.deb")))
+        self.assertIn("Filename: dists/jammy/pool/stable/amd64/b/baz/baz_1.0_amd64.deb", self.read_packages())
+
+    def test_update_waits_for_other_processes(self):
+        build_deb(self.pool_path, "bar")
+        with open(self.dist.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)  # Stands in for a --migrate-pool process.
+            update_thread = Thread(target=self.dist.update)
+            update_thread.start()
+            time.sleep(0.5)
+            self.assertTrue(update_thread.is_alive())
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        update_thread.join(10)
+        self.assertIn("Package: bar", self.read_packages())
+
+
+class TestArchitectureAll(unittest.TestCase):
+    def setUp(self):
+        self.debian_dir = os.path.realpath("test_arch_all")
+        self.dist = Distribution("jammy", os.path.join(self.debian_dir, "dists", "jammy"), ["amd64", "arm64"],
+                                 ["stable"], os.path.join(self.debian_dir, "keyring"), self.debian_dir,
+                                 "Test repository")
+        self.dist.set_key_id("")
+        self.pool_dir = os.path.join(self.dist.pool_dir, "stable")
+        for arch in ["amd64", "all"]:
+            os.makedirs(os.path.join(self.pool_dir, arch), exist_ok=True)
+
+    def tearDown(self):
+        shutil.rmtree(self.debian_dir)
+
+    def read(self, *parts):
+        with open(os.path.join(self.dist.dist_dir, *parts)) as f:
+            return f.read()
+
+    def test_all_packages_are_merged(self):
+        build_deb(os.path.join(self.pool_dir, "amd64"), "native", arch="amd64")
+        build_deb(os.path.join(self.pool_dir, "all"), "docs", arch="all")
+        self.dist.update()
+
+        amd64 = self.read("stable", "binary-amd64", "Packages")
+        self.assertIn("Package: native", amd64)
+        self.assertIn("Filename: dists/jammy/pool/stable/all/docs_1.0_all.deb", amd64)
+        self.assertIn("\n\nPackage: docs", amd64)
+        arm64 = self.read("stable", "binary-arm64", "Packages")
+        self.assertEqual(arm64.count("Package: "), 1)
+        self.assertIn("Package: docs", arm64)
+        self.assertEqual(self.read("stable", "binary-all", "Packages").count("Package: "), 1)
+
+        release = self.read("Release")
+        self.assertIn("Architectures: all amd64 arm64\n", release)
+        self.assertIn("No-Support-for-Architecture-all: Packages\n", release)
+        self.assertIn("stable/binary-all/Packages", release)
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file